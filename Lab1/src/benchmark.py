@@ -0,0 +1,76 @@
+import time
+import functools
+import numpy as np
+from src.simulator import AstralSimulator, summation_kernels, exact_sum, dopri5_step
+
+# run from the Lab1 directory: python -m src.benchmark
+
+
+def sum_accuracy(n=20000):
+    """For each summation kernel, the error of its sums of the simulator's
+    noise against the exact sums, and how many steps it sums per second"""
+    noise = AstralSimulator().noise(n)
+    exact = exact_sum(noise)
+    results = {}
+    print("{:>10} {:>14} {:>14} {:>14}".format("kernel", "max error", "mean error", "steps/s"))
+    for name, kernel in summation_kernels.items():
+        start = time.perf_counter()
+        sums = kernel(noise)
+        rate = n / (time.perf_counter() - start)
+        error = np.abs(sums - exact)
+        results[name] = (np.max(error), np.mean(error), rate)
+        print("{:>10} {:>14.3g} {:>14.3g} {:>14.0f}".format(name, *results[name]))
+    return results
+
+
+def attitude_drift(n=20000, threshold=1.0):
+    """For each summation kernel, run the simulator with the noise added up
+    by that kernel (and left uncorrected), and report the first step at
+    which the attitude error (as shown by AstralViewer) against the run
+    with exact sums exceeds threshold degrees, or None if it never does"""
+    init = [0.5, 0.25, -0.25]
+    keep = lambda x, noise: x
+    exact = np.array(AstralSimulator(summation="exact").simulate(n, init, keep))
+    results = {}
+    print("{:>10} {:>24}".format("kernel", "steps to {} degree error".format(threshold)))
+    for name in summation_kernels:
+        approx = np.array(AstralSimulator(summation=name).simulate(n, init, keep))
+        error = np.degrees(np.sum(np.abs(approx - exact), axis=1) * 0.01)
+        over = np.flatnonzero(~(error < threshold))
+        results[name] = int(over[0]) if len(over) else None
+        print("{:>10} {:>24}".format(name, str(results[name])))
+    return results
+
+
+def _sample(trajectory, dt, every):
+    # the states at multiples of `every` seconds
+    k = int(round(every / dt))
+    return trajectory[k - 1::k]
+
+
+def integrator_cost(seconds=5.0, every=0.05,
+                    setups=(("euler", 0.01), ("euler", 0.001), ("euler", 0.0001),
+                            ("rk4", 0.01), ("rk4", 0.002), ("dopri5", 0.01), ("dopri5", 0.05))):
+    """For each (integrator, dt), the largest error of an uncorrected run of
+    `seconds` simulated seconds (sampled every `every` seconds) against a
+    very tight Dormand-Prince run, with the evaluations of the derivative
+    and the wall time it took per simulated second"""
+    init = [0.5, 0.25, -0.25]
+    tight = functools.partial(dopri5_step, rtol=1e-12, atol=1e-14)
+    reference = _sample(np.array(AstralSimulator(integrator=tight).simulate(int(round(seconds / 0.01)), init)), 0.01, every)
+    results = {}
+    print("{:>8} {:>8} {:>12} {:>12} {:>14}".format("method", "dt", "max error", "nfev/s", "wall ms/s"))
+    for integrator, dt in setups:
+        sim = AstralSimulator(integrator=integrator, dt=dt)
+        trajectory = _sample(np.array(sim.simulate(int(round(seconds / dt)), init)), dt, every)
+        error = np.max(np.abs(trajectory - reference))
+        results[(integrator, dt)] = (error, sim.stats["nfev_per_second"], sim.stats["wall_per_second"])
+        print("{:>8} {:>8} {:>12.3g} {:>12.0f} {:>14.2f}".format(
+            integrator, dt, error, sim.stats["nfev_per_second"], sim.stats["wall_per_second"] * 1000))
+    return results
+
+
+if __name__ == "__main__":
+    sum_accuracy()
+    attitude_drift()
+    integrator_cost()
@@ -1,62 +1,417 @@
+import math
+import time
 import numpy as np
 
 
+def _zeroed(a):
+    # nan terms count as zero, as in np.nansum
+    return np.where(np.isnan(a), 0.0, a)
+
+
+def naive_sum(a):
+    """Sum along the last axis of a, left to right, one term at a time"""
+    a = _zeroed(a)
+    total = np.zeros(a.shape[:-1])
+    for j in range(a.shape[-1]):
+        total += a[..., j]
+    return total
+
+
+def pairwise_sum(a):
+    """Sum along the last axis of a by adding neighbouring pairs,
+    then pairs of pairs, and so on"""
+    a = _zeroed(a)
+    while a.shape[-1] > 1:
+        if a.shape[-1] % 2:
+            a = np.concatenate([a, np.zeros(a.shape[:-1] + (1,))], axis=-1)
+        a = a[..., 0::2] + a[..., 1::2]
+    return a[..., 0]
+
+
+def kahan_sum(a):
+    """Sum along the last axis of a, left to right, carrying the
+    rounding error of each addition on to the next"""
+    a = _zeroed(a)
+    total = np.zeros(a.shape[:-1])
+    c = np.zeros_like(total)
+    for j in range(a.shape[-1]):
+        y = a[..., j] - c
+        t = total + y
+        c = (t - total) - y
+        total = t
+    return total
+
+
+def neumaier_sum(a):
+    """Kahan summation that also copes with terms bigger than the total so far"""
+    a = _zeroed(a)
+    total = np.zeros(a.shape[:-1])
+    c = np.zeros_like(total)
+    for j in range(a.shape[-1]):
+        x = a[..., j]
+        t = total + x
+        c += np.where(np.abs(total) >= np.abs(x), (total - t) + x, (x - t) + total)
+        total = t
+    return total + c
+
+
+def exact_sum(a):
+    """Correctly rounded sums along the last axis of a, with math.fsum
+    (one row at a time, so much slower than the others)"""
+    a = _zeroed(a)
+    rows = a.reshape(-1, a.shape[-1])
+    return np.array([math.fsum(row) for row in rows]).reshape(a.shape[:-1])
+
+
+# ways of summing each step's noise terms; each sums along the last axis,
+# across all the steps at once
+summation_kernels = {
+    "numpy": lambda a: np.nansum(a, axis=-1),
+    "naive": naive_sum,
+    "pairwise": pairwise_sum,
+    "kahan": kahan_sum,
+    "neumaier": neumaier_sum,
+    "exact": exact_sum,
+}
+
+
+def lorenz(state, p, s, b):
+    """Time derivative of the state (x, y, z), stacked along the first axis"""
+    x, y, z = state
+    return np.array([s * (y - x), x * (p - z) - y, x * y - b * z])
+
+
+# integrators advance a state by dt, returning the new state, the number
+# of evaluations of f used, and the substep to start from next time (if any)
+
+def euler_step(f, state, dt, h=None):
+    """One forward Euler step"""
+    return state + dt * f(state), 1, h
+
+
+def rk4_step(f, state, dt, h=None):
+    """One classical fourth order Runge-Kutta step"""
+    k1 = f(state)
+    k2 = f(state + dt / 2 * k1)
+    k3 = f(state + dt / 2 * k2)
+    k4 = f(state + dt * k3)
+    return state + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4), 4, h
+
+
+# Dormand-Prince 5(4) coefficients; _DP_E is the difference between
+# the fifth and fourth order weights, which estimates the error
+_DP_A = [[],
+         [1/5],
+         [3/40, 9/40],
+         [44/45, -56/15, 32/9],
+         [19372/6561, -25360/2187, 64448/6561, -212/729],
+         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+         [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+_DP_B = [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0]
+_DP_E = [b - b4 for b, b4 in zip(_DP_B, [5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40])]
+
+
+def dopri5_step(f, state, dt, h=None, rtol=1e-6, atol=1e-9, min_h=None):
+    """Dormand-Prince 5(4) with error control: advance by dt in as many
+    substeps as needed to keep the estimated error of each within
+    atol + rtol * |state|. h is the substep to try first (dt if None).
+    A state that is no longer finite is stepped as is, so the NaNs
+    propagate; a substep that would have to shrink below min_h
+    (1e-10 * dt if None) raises a RuntimeError."""
+    h = dt if h is None else h
+    min_h = 1e-10 * dt if min_h is None else min_h
+    t, nfev = 0.0, 0
+    while dt - t > 1e-12 * dt:
+        step = min(h, dt - t)
+        k = []
+        for a in _DP_A:
+            k.append(f(state + step * sum(aj * kj for aj, kj in zip(a, k))))
+        nfev += len(k)
+        new = state + step * sum(bj * kj for bj, kj in zip(_DP_B, k))
+        error = step * sum(ej * kj for ej, kj in zip(_DP_E, k))
+        scale = atol + rtol * np.maximum(np.abs(state), np.abs(new))
+        # RMS error of each trajectory (column of an ensemble); the worst
+        # finite one sets the step, the non-finite ones are just carried along
+        norms = np.ravel(np.sqrt(np.mean((error / scale)**2, axis=0)))
+        norms = norms[np.isfinite(norms)]
+        norm = np.max(norms) if len(norms) else 0.0
+        if norm <= 1:
+            t += step
+            state = new
+        elif step <= min_h:
+            raise RuntimeError("dopri5_step: substep {:g} too small for the tolerance".format(step))
+        # grow or shrink the substep towards the tolerance
+        h = step * (5.0 if norm == 0 else min(5.0, max(0.2, 0.9 * norm**-0.2)))
+    return state, nfev, h
+
+
+integrators = {"euler": euler_step, "rk4": rk4_step, "dopri5": dopri5_step}
+
+
+# number of steps of noise drawn at a time by simulate_ensemble,
+# and passed to a block_corrector at a time
+_NOISE_BLOCK = 1024
+
 
 class AstralSimulator:
-    def __init__(self):        
-        self.dt = 0.01
+    def __init__(self, rng=None, summation="numpy", integrator="euler", dt=0.01):        
+        """rng: None for the usual setup, drawn from a private stream seeded
+        with 2018 (the global numpy RNG is left alone); or a seed or Generator,
+        from which every call to simulate spawns an independent stream
+        summation: how each step's noise terms are added up, one of
+        summation_kernels or a function summing along the last axis
+        integrator: how each step is integrated, one of integrators or a
+        function like them (e.g. functools.partial(dopri5_step, rtol=1e-9))
+        dt: time step; higher order integrators can use longer steps
+        After each run, stats holds the number of evaluations of the
+        derivative and the wall time, in total and per simulated second."""
+        self.dt = dt
+        self.summation = summation_kernels.get(summation, summation)
+        self.integrator = integrators.get(integrator, integrator)
+        self.stats = {}
         self.p = 32
         self.s = 8
         self.b = 8.0 / 3.0
-        np.random.seed(2018)
-        self.sizes = np.exp(np.random.uniform(-18, 4, 40)) * 1e-16
+        if rng is None:
+            self.rng = np.random.RandomState(2018)
+        else:
+            self.rng = np.random.default_rng(rng)
+        self.sizes = np.exp(self.rng.uniform(-18, 4, 40)) * 1e-16
         
 
+    def _record_stats(self, nfev, start, n):
+        elapsed = time.perf_counter() - start
+        simulated = n * self.dt
+        # the rates are undefined (nan) for a run of no steps
+        per_second = 1.0 / simulated if simulated else np.nan
+        self.stats = {"nfev": nfev, "seconds": elapsed, "simulated_seconds": simulated,
+                      "nfev_per_second": nfev * per_second, "wall_per_second": elapsed * per_second}
+
+    def _stream(self, rng=None):
+        # the random stream for one run
+        if rng is not None:
+            return rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
+        if isinstance(self.rng, np.random.Generator):
+            return self.rng.spawn(1)[0]
+        return self.rng
 
-    def simulate(self, n, init, corrector=None):
+    def simulate(self, n, init, corrector=None, rng=None, block_corrector=None):
+        """n: number of steps
+        init: initial (x, y, z)
+        corrector(x, noise): called every step with x, after the noise has
+                been added to it, and that step's (40,) noise; returns the corrected x
+        rng: random stream for this run (see __init__)
+        block_corrector(noise_sums, noise): alternative to corrector, for
+                corrections that don't depend on x: called with the (k,)
+                summed noise and (k, 40) noise of a block of up to 1024 steps,
+                and returns the (k,) amounts to subtract from x at each of
+                them. Gives exactly the same result as the equivalent
+                corrector(x, noise) = x - correction(noise).
+        """
+        start = time.perf_counter()
         results = []
         x, y, z = init
-        noise = np.random.normal(0, 1, (n, self.sizes.shape[0])) * self.sizes
-        noise[100:][noise[100:]<1e-48] = np.nan        
+        noise = self.noise(n, rng)
+        # summing every row at once gives the same sums as row by row
+        noise_sums = self.summation(noise)
+        f = lambda state: lorenz(state, self.p, self.s, self.b)
+        nfev, h = 0, None
         
         for i in range(n):
-            zn = z + self.dt * (x * y - self.b * z)
-            yn = y + self.dt * (x * (self.p - z) - y)
-            xn = x + self.dt * (self.s * (y - x))
-            x, y, z = xn, yn, zn
+            if self.integrator is euler_step:
+                zn = z + self.dt * (x * y - self.b * z)
+                yn = y + self.dt * (x * (self.p - z) - y)
+                xn = x + self.dt * (self.s * (y - x))
+                x, y, z = xn, yn, zn
+                nfev += 1
+            else:
+                state, evals, h = self.integrator(f, np.array([x, y, z]), self.dt, h)
+                x, y, z = state
+                nfev += evals
             
             if corrector:                                               
-                x += np.nansum(noise[i,:])
+                x += noise_sums[i]
                 x = corrector(x, noise[i,:])            
+            elif block_corrector:
+                if i % _NOISE_BLOCK == 0:
+                    corrections = block_corrector(noise_sums[i:i+_NOISE_BLOCK], noise[i:i+_NOISE_BLOCK])
+                x += noise_sums[i]
+                x -= corrections[i % _NOISE_BLOCK]
             results.append([x, y, z])
+        self._record_stats(nfev, start, n)
         return results
 
+    def noise(self, n, rng=None):
+        """The (n, 40) noise terms of a run of n steps, as simulate draws them"""
+        return self._noise_block(self._stream(rng), 0, n, 1)[:, 0]
+
+    def _noise_block(self, stream, start, stop, m):
+        # the noise of steps start..stop-1 for m trajectories, drawn and
+        # masked the same way as in simulate
+        noise = stream.normal(0, 1, (stop - start, m, self.sizes.shape[0])) * self.sizes
+        late = noise[max(100 - start, 0):]
+        late[late<1e-48] = np.nan
+        return noise
+
+    def simulate_ensemble(self, n, init, params=None, corrector=None, rng=None, out=None,
+                          block_corrector=None):
+        """Integrate M trajectories at once, as arrays.
+        n: number of steps
+        init: (M, 3) initial conditions, or one (3,) shared by all of them
+        params: (M, 3) parameters (p, s, b), one set per trajectory,
+                or one (3,) set; the simulator's own by default
+        corrector(x, noise): as for simulate, but called with the (M,) x
+                coordinates and the (M, 40) noise of every trajectory at once
+        rng: as for simulate; each trajectory gets its own noise
+        out: optional (M, n, 3) array to write the trajectories into
+        block_corrector(noise_sums, noise): as for simulate, but called with
+                (k, M) noise sums and (k, M, 40) noise, returning (k, M) corrections
+        Returns the (M, n, 3) trajectories; with M=1, the same numbers as simulate.
+        """
+        start = time.perf_counter()
+        init = np.atleast_2d(np.asarray(init, dtype=float))
+        if params is None:
+            params = [self.p, self.s, self.b]
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        m = max(len(init), len(params))
+        x, y, z = np.broadcast_to(init, (m, 3)).T.copy()
+        p, s, b = np.broadcast_to(params, (m, 3)).T
+        xs = np.empty((m, n, 3)) if out is None else out
+        correct = corrector or block_corrector
+        if correct:
+            stream = self._stream(rng)
+        f = lambda state: lorenz(state, p, s, b)
+        nfev, h = 0, None
+
+        for i in range(n):
+            if self.integrator is euler_step:
+                zn = z + self.dt * (x * y - b * z)
+                yn = y + self.dt * (x * (p - z) - y)
+                xn = x + self.dt * (s * (y - x))
+                x, y, z = xn, yn, zn
+                nfev += 1
+            else:
+                state, evals, h = self.integrator(f, np.array([x, y, z]), self.dt, h)
+                x, y, z = state
+                nfev += evals
+
+            if correct:
+                if i % _NOISE_BLOCK == 0:
+                    noise = self._noise_block(stream, i, min(i + _NOISE_BLOCK, n), m)
+                    noise_sums = self.summation(noise)
+                    if block_corrector:
+                        corrections = block_corrector(noise_sums, noise)
+                j = i % _NOISE_BLOCK
+                x += noise_sums[j]
+                if corrector:
+                    x = corrector(x, noise[j])
+                else:
+                    x -= corrections[j]
+            xs[:, i, 0] = x
+            xs[:, i, 1] = y
+            xs[:, i, 2] = z
+        self._record_stats(nfev * m, start, n)
+        return xs
+
     def run(self, n, corrector):
         approx = self.simulate(n, [0.5, 0.25, -0.25], corrector)
         true = self.simulate(n, [0.5, 0.25, -0.25])
         return np.array(true), np.array(approx)
 
 
-from jhwutils.tkanvas import TKanvas
-from jhwutils.transformations import euler_matrix
+try:
+    from jhwutils.tkanvas import TKanvas
+except ImportError:
+    # no Tk: AstralViewer can still render headless, see AstralViewer.frames
+    TKanvas = None
+
+try:
+    from jhwutils.transformations import euler_matrix
+except ImportError:
+    def euler_matrix(ai, aj, ak):
+        # 4x4 rotation by static x, y, z Euler angles, as jhwutils' euler_matrix(ai, aj, ak)
+        si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
+        ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+        cc, cs, sc, ss = ci*ck, ci*sk, si*ck, si*sk
+        m = np.eye(4)
+        m[:3, :3] = [[cj*ck, sj*sc-cs, sj*cc+ss],
+                     [cj*sk, sj*ss+cc, sj*cs-sc],
+                     [-sj, cj*si, cj*ci]]
+        return m
+
+
+class ArrayCanvas:
+    """Headless stand-in for TKanvas, with the drawing calls AstralViewer
+    uses (clear, rectangle, circle, line, text), rasterised with PIL into
+    an image that image() returns as an (h, w, 3) uint8 array"""
+    def __init__(self, w=800, h=800, background="black"):
+        import PIL.Image, PIL.ImageDraw, PIL.ImageFont
+        self.w, self.h = w, h
+        self.cx = w/2
+        self.cy = h/2
+        self.background = background
+        self._image = PIL.Image.new("RGB", (w, h), background)
+        self._draw = PIL.ImageDraw.Draw(self._image)
+        self._font = PIL.ImageFont.load_default
+
+    def clear(self):
+        self._draw.rectangle((0, 0, self.w, self.h), fill=self.background)
+
+    def rectangle(self, x1, y1, x2, y2, fill=None, outline=None, width=1, **kw):
+        self._draw.rectangle((x1, y1, x2, y2), fill=fill or None, outline=outline or None, width=width)
+
+    def circle(self, x, y, r, fill=None, outline=None, width=1, **kw):
+        self._draw.ellipse((x-r, y-r, x+r, y+r), fill=fill or None, outline=outline or None, width=width)
+
+    def line(self, x1, y1, x2, y2, fill="black", width=1, **kw):
+        self._draw.line((x1, y1, x2, y2), fill=fill, width=width)
+
+    def text(self, x, y, text="", fill="black", font=None, anchor="center", **kw):
+        # centred on (x, y), like Tk; the font size is taken from a Tk font tuple
+        size = font[1] if font else 12
+        try:
+            pil_font = self._font(size=size)
+        except TypeError:
+            pil_font = self._font()
+        left, top, right, bottom = self._draw.textbbox((0, 0), text, font=pil_font)
+        if anchor == "w":
+            x, y = x - left, y - (top + bottom) / 2
+        else:
+            x, y = x - (left + right) / 2, y - (top + bottom) / 2
+        self._draw.text((x, y), text, fill=fill, font=pil_font)
+
+    def image(self):
+        return np.asarray(self._image).copy()
 
 
 class AstralViewer:
-    def __init__(self, approx, true):
-        np.random.seed(2018)
+    def __init__(self, approx, true, headless=False):
+        """approx, true: (n, 3) trajectories, as returned by AstralSimulator.run
+        headless: if True, don't open a Tk window; draw frames with frames() or render()"""
+        # private stream, so the global numpy RNG is left alone
+        self.rng = np.random.RandomState(2018)
         # generate some random stars
-        stars = np.random.uniform(-1, 1, (32, 4))
+        stars = self.rng.uniform(-1, 1, (32, 4))
         stars[:, :3] = (stars[:, :3].T / np.sum(stars[:, :3], axis=1).T).T
         stars[:, 3] = 1
 
-        star_size = np.random.uniform(2, 6, (16,))
+        star_size = self.rng.uniform(2, 6, (16,))
         self.stars = stars
         self.star_size = star_size
-        self.kanvas = TKanvas(draw_fn=self.draw, w=800, h=800)
+        self.kanvas = None if headless else TKanvas(draw_fn=self.draw, w=800, h=800)
         self.tstep = 0
         self.approx = approx
         self.true = true
 
+    def _project(self, mat, scale, canvas):
+        # project all the drawn stars at once (only one per star size is
+        # drawn); returns their screen positions, sizes and which are in view
+        stars = self.stars[:len(self.star_size)] @ mat.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x, y = stars[:, 0] / stars[:, 2], stars[:, 1] / stars[:, 2]
+            visible = (stars[:, 2] > 0) & (np.sqrt(x ** 2 + y ** 2) < 0.9)
+        return x * scale + canvas.cx, y * scale + canvas.cy, visible
+
     def draw(self, canvas):
         canvas.clear()
         roll = self.tstep / 1800.0
@@ -76,11 +431,11 @@ class AstralViewer:
         if np.isfinite(error):
             mat = euler_matrix(*(self.approx[self.tstep] - self.true[self.tstep]) * 0.01)
         else:
-            mat = euler_matrix(*np.random.uniform(-np.pi, np.pi, 3))
+            mat = euler_matrix(*self.rng.uniform(-np.pi, np.pi, 3))
 
         traj_mat = euler_matrix(0, 0, roll)
         self.tstep += 1
-        if self.tstep>=len(self.true):
+        if self.tstep>=len(self.true) and self.kanvas is not None:
             self.kanvas.quit(None)
 
         hor1 = traj_mat @ np.array([-1,0,0,1]) 
@@ -92,24 +447,17 @@ class AstralViewer:
 
         scale = max_rad * 0.5
         # reference points
-        for star, rad in zip(self.stars, self.star_size):
-            star = traj_mat @ star
-            x, y = star[0] / star[2], star[1] / star[2]
-            if star[2] > 0 and np.sqrt(x ** 2 + y ** 2) < 0.9:
-                l = 20
-                x, y = x * scale + canvas.cx, y * scale + canvas.cy
-                canvas.circle(x, y, rad + 1, fill="lightblue")
-                canvas.line(x - l, y, x + l, y, fill="lightblue")
-                canvas.line(x, y - l, x, y + l, fill="lightblue")
+        xs, ys, visible = self._project(traj_mat, scale, canvas)
+        for x, y, rad in zip(xs[visible], ys[visible], self.star_size[visible]):
+            l = 20
+            canvas.circle(x, y, rad + 1, fill="lightblue")
+            canvas.line(x - l, y, x + l, y, fill="lightblue")
+            canvas.line(x, y - l, x, y + l, fill="lightblue")
 
         # projected points
-        for star, rad in zip(self.stars, self.star_size):
-            star = traj_mat @ mat @ star
-            x, y = star[0] / star[2], star[1] / star[2]
-            if star[2] > 0 and np.sqrt(x ** 2 + y ** 2) < 0.9:
-                canvas.circle(
-                    x * scale + canvas.cx, y * scale + canvas.cy, rad, fill="white"
-                )
+        xs, ys, visible = self._project(traj_mat @ mat, scale, canvas)
+        for x, y, rad in zip(xs[visible], ys[visible], self.star_size[visible]):
+            canvas.circle(x, y, rad, fill="white")
 
         # text
         canvas.text(canvas.cx, canvas.h-20, text="Target roll: {roll:.1f}".format(roll=np.degrees(roll)), fill='white', font=('Arial', 15))
@@ -118,3 +466,17 @@ class AstralViewer:
         else:
             canvas.text(canvas.cx, 30, text="Attitude error: {error:.1f} degrees".format(error=np.degrees(error)), fill='black', font=('Arial', 20))
 
+    def frames(self, n=None, w=800, h=800, every=1):
+        """Draw frames without Tk, yielding every `every`th one as an (h, w, 3)
+        uint8 image; n frames, or until the end of the trajectory"""
+        canvas = ArrayCanvas(w, h)
+        n = len(self.true) - self.tstep if n is None else min(n, len(self.true) - self.tstep)
+        for i in range(n):
+            self.draw(canvas)
+            if i % every == 0:
+                yield canvas.image()
+
+    def render(self, n=None, w=200, h=200, every=1):
+        """The frames as one (frames, h, w, 3) array with values in [0, 1],
+        e.g. for utils.image_audio.show_gif"""
+        return np.array(list(self.frames(n, w, h, every)), dtype=np.float32) / 255
@@ -1,38 +1,94 @@
 import numpy as np
+
+
+def _grow(buf, n):
+    # return buf, or a copy of it with room for at least n rows;
+    # capacity doubles each time, so appending is O(1) amortised
+    if n <= len(buf):
+        return buf
+    grown = np.empty((max(n, 2 * len(buf)),) + buf.shape[1:], dtype=buf.dtype)
+    grown[:len(buf)] = buf
+    return grown
+
+
 class History:
-    def __init__(self):
-        self.all_theta = []
-        self.all_loss = []
-        self.best_thetas = []
-        self.best_losses = []
-        self.all_best = []
+    def __init__(self, capacity=1024):
+        # everything is stored in preallocated arrays that grow as needed;
+        # the theta buffers are allocated once the first theta is seen
+        self._theta = None
+        self._loss = np.empty(capacity)
+        self._trace = np.empty(capacity)
+        self._is_best = np.empty(capacity, dtype=bool)
+        self._best_theta = None
+        self._best_loss = np.empty(64)
+        self._best_iter = np.empty(64, dtype=int)
+        self.n_best = 0
         self.best = np.inf
         self.best_theta = None
-        self.loss_trace = []
         self.iters = 0
-        
+
+    # the filled part of each buffer, as views
+    @property
+    def all_theta(self):
+        return np.empty(0) if self._theta is None else self._theta[:self.iters]
+
+    @property
+    def all_loss(self):
+        return self._loss[:self.iters]
+
+    @property
+    def loss_trace(self):
+        return self._trace[:self.iters]
+
+    @property
+    def all_best(self):
+        return self._is_best[:self.iters]
+
+    @property
+    def best_thetas(self):
+        return np.empty(0) if self._best_theta is None else self._best_theta[:self.n_best]
+
+    @property
+    def best_losses(self):
+        return self._best_loss[:self.n_best]
+
+    @property
+    def best_iters(self):
+        return self._best_iter[:self.n_best]
     
     def track(self, theta, loss, force=False):
-        self.all_theta.append(theta)
-        self.all_loss.append(loss)
+        theta = np.asarray(theta, dtype=float)
+        if self._theta is None:
+            self._theta = np.empty((len(self._loss),) + theta.shape)
+            self._best_theta = np.empty((len(self._best_loss),) + theta.shape)
         self.iters += 1
+        n = self.iters
         is_best = False
         if loss<self.best or force:
             self.best = loss
-            self.best_theta = theta
-            self.best_losses.append(self.best)
-            self.best_thetas.append(self.best_theta)
+            self.n_best += 1
+            if self.n_best > len(self._best_loss):
+                self._best_theta = _grow(self._best_theta, self.n_best)
+                self._best_loss = _grow(self._best_loss, self.n_best)
+                self._best_iter = _grow(self._best_iter, self.n_best)
+            self._best_theta[self.n_best - 1] = theta
+            self._best_loss[self.n_best - 1] = loss
+            self._best_iter[self.n_best - 1] = n
+            self.best_theta = self._best_theta[self.n_best - 1]
             is_best = True
-        self.loss_trace.append(self.best)
-        self.all_best.append(is_best)
+        if n > len(self._loss):
+            self._theta = _grow(self._theta, n)
+            self._loss = _grow(self._loss, n)
+            self._trace = _grow(self._trace, n)
+            self._is_best = _grow(self._is_best, n)
+        self._theta[n - 1] = theta
+        self._loss[n - 1] = loss
+        self._trace[n - 1] = self.best
+        self._is_best[n - 1] = is_best
         return is_best
     
     def finalise(self):
-        self.all_theta = np.array(self.all_theta)
-        self.all_loss = np.array(self.all_loss)
-        self.best_losses = np.array(self.best_losses)
-        self.best_thetas = np.array(self.best_thetas)
+        # nothing to copy; the public attributes are already array views
         self.theta = np.array(self.best_theta)
         self.loss = np.array(self.best)
-        self.loss_trace = np.array(self.loss_trace)
-        return self
\ No newline at end of file
+        return self
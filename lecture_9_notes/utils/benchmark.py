@@ -0,0 +1,219 @@
+import time
+import json
+import functools
+import numpy as np
+from utils.optimisers import genetic_search, steady_state_genetic_search, random_search, hill_climbing, simulated_anneal, gradient_descent
+from utils.optimisers import grid_search, simulated_anneal_chains, momentum_descent, nesterov_descent, adam, line_search_descent
+from utils.optimisers import successive_halving, hyperband
+from utils.objectives import rosenbrock, rastrigin, ackley, pid_loss
+
+
+def sphere(theta):
+    # cheap loss, so that the timings measure optimiser overhead
+    return np.sum(theta**2, axis=-1)
+
+
+def mutate(theta):
+    return theta + np.random.normal(0, 0.1, theta.shape)
+
+
+def generations_per_second(pop, d=8, iters=20, vectorized=False):
+    """Time genetic_search on the sphere function and return
+    the number of generations it completes per second"""
+    guess = lambda: np.random.normal(0, 1, d)
+    start = time.perf_counter()
+    genetic_search(sphere, pop, guess, mutate, iters, vectorized=vectorized)
+    return iters / (time.perf_counter() - start)
+
+
+def bench_genetic(pops=(100, 1000, 10000), d=8, iters=20):
+    """Compare the per-individual loop with the vectorized mode
+    of genetic_search at several population sizes"""
+    print("{:>8} {:>14} {:>14} {:>8}".format("pop", "loop gen/s", "vector gen/s", "speedup"))
+    for pop in pops:
+        loop = generations_per_second(pop, d, iters, vectorized=False)
+        vector = generations_per_second(pop, d, iters, vectorized=True)
+        print("{:>8} {:>14.2f} {:>14.2f} {:>7.1f}x".format(pop, loop, vector, vector / loop))
+
+
+
+def _simulate_unfused(controller, reference, rate=50):
+    # drone.simulate as it was before the update was fused, for comparison:
+    # three matmuls per step, plus air resistance and gravity, and noise drawn step by step
+    ts = np.arange(len(reference)) / rate
+    disturbance = np.array([np.cos(ts*0.035), np.sin(ts*0.02), np.cos(ts*0.05)]).T + np.array([-0.1,4,0.0])
+    x = np.zeros(9,)
+    dt = 0.002
+    dynamics = np.diag(np.ones(9), 0) + np.diag(np.ones(6), 3)*dt
+    observe_matrix = np.eye(9)[:, 0:3]
+    control_matrix = np.eye(9)[:, 3:6] * 0.1
+    disturbance_matrix = np.eye(9)[:, [5, 3, 4]] * 0.6
+    xs = []
+    for i in range(len(reference)):
+        inp = np.clip(controller(x @ observe_matrix, reference[i,:]), -55, 55)
+        d = disturbance[i] + np.random.normal(0, 15, disturbance[i].shape)
+        if x[2]<0.05:
+            d *= 0
+            x[3:5] *= 0.2
+            x[2] = np.maximum(x[2],0)
+        x = dynamics @ x + control_matrix @ inp + disturbance_matrix @ d
+        x[3:6] *= 0.99
+        x[8] -= 0.08
+        xs.append(x)
+    return np.array(xs)[:,0:3]
+
+
+def bench_simulate(steps=2000, batches=(1, 100, 1000)):
+    """Simulated drone steps per second: the unfused single flight,
+    simulate with the fused update, and simulate_batch with a PIDBank"""
+    from utils.drone import simulate, simulate_batch, pid_controller, PIDBank
+    reference = np.zeros((steps, 3)) + np.array([0, 0, 1])
+    gains = np.array([1.0, 0.01, 5.0])
+    def rate(fn):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+    before = steps / rate(lambda: _simulate_unfused(pid_controller(gains), reference))
+    after = steps / rate(lambda: simulate(pid_controller(gains), reference))
+    print("{:>24} {:>14.0f} steps/s".format("unfused simulate", before))
+    print("{:>24} {:>14.0f} steps/s ({:.1f}x)".format("fused simulate", after, after / before))
+    for n in batches:
+        batch = n * steps / rate(lambda: simulate_batch(PIDBank(np.tile(gains, (n, 1))), reference, n))
+        print("{:>24} {:>14.0f} steps/s ({:.1f}x)".format("simulate_batch n={}".format(n), batch, batch / before))
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class Budget:
+    """Wraps a loss function to count its evaluations and the time spent,
+    and stops the optimiser using it (by raising BudgetExhausted) once
+    either budget is used up. Records the best loss so far each time
+    it improves, against evaluations and seconds.
+    """
+    def __init__(self, L, evals=None, seconds=None):
+        self.L = L
+        self.max_evals = evals
+        self.max_seconds = seconds
+        self.evals = 0
+        self.best = np.inf
+        self.curve = []
+        self.start = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.start
+
+    def __call__(self, theta):
+        if (self.max_evals and self.evals >= self.max_evals) or (self.max_seconds and self.seconds >= self.max_seconds):
+            raise BudgetExhausted()
+        loss = self.L(theta)
+        self.evals += 1
+        if loss < self.best:
+            self.best = float(loss)
+            self.curve.append((self.evals, self.seconds, self.best))
+        return loss
+
+
+# effectively unlimited iterations; the budget stops every run
+_forever = 10**12
+
+
+def _rows(L):
+    # a vectorized loss from a single-theta one, so every row goes through the Budget
+    return lambda thetas: np.array([L(theta) for theta in thetas])
+
+
+def _restarted(run):
+    # optimisers that finish on their own are rerun until the budget stops them
+    while True:
+        run()
+
+
+def optimisers(d, scale):
+    """Every optimiser in utils.optimisers, as a function of the loss only,
+    set up for a d dimensional problem on [-scale, scale]^d.
+    The problems have no cheaper low-budget evaluations, so successive_halving
+    and hyperband ignore the budget and just re-evaluate their survivors."""
+    guess = lambda: np.random.uniform(-scale, scale, d)
+    neighbour = lambda theta: theta + np.random.normal(0, scale * 0.02, np.shape(theta))
+    ignore_budget = lambda L: lambda theta, budget: L(theta)
+    return {
+        "random_search": lambda L: random_search(L, guess, _forever),
+        "grid_search": lambda L: grid_search(L, [[-scale, scale]] * d, 16, order="strided"),
+        "hill_climbing": lambda L: hill_climbing(L, guess, neighbour, _forever),
+        "simulated_anneal": lambda L: simulated_anneal(L, guess, neighbour, lambda i: 0.1, _forever),
+        "simulated_anneal_chains": lambda L: simulated_anneal_chains(_rows(L), guess, neighbour, lambda i: 0.1, _forever),
+        "genetic_search": lambda L: genetic_search(L, 50, guess, neighbour, _forever),
+        "steady_state_genetic_search": lambda L: steady_state_genetic_search(L, 50, guess, neighbour, _forever),
+        "successive_halving": lambda L: _restarted(lambda: successive_halving(ignore_budget(L), guess, 81, 27)),
+        "hyperband": lambda L: _restarted(lambda: hyperband(ignore_budget(L), guess, 27)),
+        "gradient_descent": lambda L: gradient_descent(L, None, guess(), 1e-4, tol=0, maxiter=_forever),
+        "momentum_descent": lambda L: momentum_descent(L, None, guess(), 1e-4, tol=0, maxiter=_forever),
+        "nesterov_descent": lambda L: nesterov_descent(L, None, guess(), 1e-4, tol=0, maxiter=_forever),
+        "adam": lambda L: adam(L, None, guess(), scale * 0.01, tol=0, maxiter=_forever),
+        "line_search_descent": lambda L: line_search_descent(L, None, guess(), tol=0, maxiter=_forever),
+    }
+
+
+# name: (loss, dimension, scale)
+problems = {
+    "rosenbrock": (rosenbrock, 4, 2.0),
+    "rastrigin": (rastrigin, 4, 5.12),
+    "ackley": (ackley, 4, 5.0),
+    # a fixed noise stream, so the loss is deterministic like the others
+    "pid": (functools.partial(pid_loss, rng=2018), 3, 2.0),
+}
+
+
+def run_suite(evals=2000, seconds=2.0, problems=problems, seed=2018, out="benchmark.json"):
+    """Run every optimiser on every problem twice, once with a budget of
+    `evals` loss evaluations and once with `seconds` of wall-clock time.
+    Saves the loss-vs-evaluations and loss-vs-seconds curves to `out` as JSON:
+    results[problem][optimiser][budget] = {"evals": [...], "seconds": [...], "loss": [...]},
+    with one entry each time the best loss improved.
+    """
+    results = {}
+    for name, (L, d, scale) in problems.items():
+        results[name] = {}
+        for opt_name, optimise in optimisers(d, scale).items():
+            results[name][opt_name] = {}
+            for budget in ["evals", "seconds"]:
+                np.random.seed(seed)
+                counter = Budget(L, evals=evals if budget == "evals" else None,
+                                 seconds=seconds if budget == "seconds" else None)
+                try:
+                    optimise(counter)
+                except BudgetExhausted:
+                    pass
+                evals_used, seconds_used, losses = zip(*counter.curve) if counter.curve else ((), (), ())
+                results[name][opt_name][budget] = {"evals": list(evals_used), "seconds": list(seconds_used),
+                                                   "loss": list(losses), "total_evals": counter.evals}
+                print("{:>12} {:>18} {:>8}: best {:.4g} after {} evaluations".format(
+                    name, opt_name, budget, counter.best, counter.evals))
+    with open(out, "w") as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+def compare(baseline, current, budget="evals"):
+    """Compare two saved suite results, printing the final loss of each
+    optimiser and problem in both, to spot regressions"""
+    with open(baseline) as f:
+        old = json.load(f)
+    with open(current) as f:
+        new = json.load(f)
+    for name in new:
+        for opt_name in new[name]:
+            before = (old.get(name, {}).get(opt_name, {}).get(budget, {}).get("loss") or [np.nan])[-1]
+            after = (new[name][opt_name][budget]["loss"] or [np.nan])[-1]
+            flag = "  <-- worse" if after > before else ""
+            print("{:>12} {:>18}: {:.4g} -> {:.4g}{}".format(name, opt_name, before, after, flag))
+
+
+if __name__ == "__main__":
+    # run from the lecture directory: python -m utils.benchmark
+    bench_genetic()
+    bench_simulate()
+    run_suite()
@@ -0,0 +1,80 @@
+import numpy as np
+from collections import OrderedDict
+
+
+class LossCache:
+    """Memoising wrapper for a loss function, for optimisers that evaluate
+    the same theta more than once (the surviving elite in genetic_search,
+    revisited states in hill_climbing and simulated_anneal).
+    L: loss function
+    maxsize: maximum number of losses kept; the least recently used go first
+    tol: if given, theta is rounded to a multiple of tol before lookup,
+         so thetas closer than that share a loss
+    vectorized: if True, L takes a (n, d) array and returns (n,) losses,
+                and only the rows missing from the cache are passed on to L
+    Only cache deterministic losses (e.g. drone flights with a fixed rng),
+    and wrap L in the main process: a process pool would give each worker
+    its own copy of the cache.
+    """
+    def __init__(self, L, maxsize=100000, tol=None, vectorized=False):
+        self.L = L
+        self.maxsize = maxsize
+        self.tol = tol
+        self.vectorized = vectorized
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, theta):
+        """The lookup key of theta: its bytes, quantised to tol if given"""
+        theta = np.asarray(theta, dtype=float)
+        if self.tol:
+            theta = np.round(theta / self.tol).astype(np.int64)
+        return theta.tobytes()
+
+    def _store(self, key, loss):
+        self.cache[key] = loss
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def __call__(self, theta):
+        if self.vectorized:
+            return self._call_many(np.asarray(theta, dtype=float))
+        key = self.key(theta)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        loss = self.L(theta)
+        self._store(key, loss)
+        return loss
+
+    def _call_many(self, thetas):
+        keys = [self.key(theta) for theta in thetas]
+        losses = np.empty(len(thetas))
+        missing = {}
+        for j, key in enumerate(keys):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                losses[j] = self.cache[key]
+            else:
+                # repeats within the batch are only evaluated once
+                missing.setdefault(key, []).append(j)
+        self.misses += len(missing)
+        self.hits += len(thetas) - len(missing)
+        if missing:
+            rows = [js[0] for js in missing.values()]
+            for (key, js), loss in zip(missing.items(), self.L(thetas[rows])):
+                losses[js] = loss
+                self._store(key, loss)
+        return losses
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+    def stats(self):
+        """Hits, misses, hit rate and current size of the cache"""
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "size": len(self.cache)}
@@ -0,0 +1,106 @@
+import os
+import json
+import numpy as np
+
+
+def save_npz(path, **arrays):
+    """Save arrays to the .npz file at path atomically: the file is written
+    under a temporary name and then renamed over the old one, so a crash
+    part way through leaves the previous checkpoint intact"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_npz(path):
+    """Return the arrays saved at path as a dict, or None if there is no such file"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def append_rows(path, array, new=False):
+    """Append the rows of array to the raw binary file at path (starting
+    a new file if new is set), and sync it to disk"""
+    with open(path, "wb" if new else "ab") as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_rows(path, rows, dtype, shape):
+    """The first rows rows of a file written by append_rows, as an array of
+    rows of the given dtype and shape; anything after them is cut off"""
+    dtype = np.dtype(dtype)
+    os.truncate(path, rows * dtype.itemsize * int(np.prod(shape, dtype=int)))
+    return np.fromfile(path, dtype=dtype).reshape((rows,) + tuple(shape))
+
+
+def rng_state():
+    """The state of the global numpy RNG, as a dict of arrays"""
+    _, keys, pos, has_gauss, gauss = np.random.get_state()
+    return {"rng_keys": keys, "rng_pos": np.array(pos),
+            "rng_has_gauss": np.array(has_gauss), "rng_gauss": np.array(gauss)}
+
+
+def set_rng_state(state):
+    """Restore the global numpy RNG from a dict made by rng_state"""
+    np.random.set_state(("MT19937", state["rng_keys"], int(state["rng_pos"]),
+                         int(state["rng_has_gauss"]), float(state["rng_gauss"])))
+
+
+class Checkpoint:
+    """Periodic checkpoints of an optimiser run: its own state (population,
+    current theta, iteration, ...), the History and the global RNG state.
+    The History arrays that only grow (History.appended and the telemetry)
+    are appended to files next to path (path + "." + name), so each save only
+    writes the rows tracked since the last one; the rest goes in one .npz,
+    which records how many rows of each file belong to the checkpoint.
+    path: file to save to; if it already exists, the run resumes from it
+    every: save after every this many iterations, to keep the I/O bounded
+    """
+    def __init__(self, path, every=10):
+        self.path = path
+        self.every = every
+        # [rows, dtype, row shape] of each appended array saved so far
+        self.rows = {}
+
+    def _file(self, name):
+        return "{}.{}".format(self.path, name)
+
+    def resume(self, history):
+        """If there is a checkpoint, restore the History and the global RNG
+        from it and return the optimiser's state as a dict; otherwise None"""
+        state = load_npz(self.path)
+        if state is None:
+            return None
+        self.rows = json.loads(str(state.pop("appended")))
+        for name, (rows, dtype, shape) in self.rows.items():
+            # rows appended by a save that didn't get as far as the .npz are dropped
+            state["history_" + name] = load_rows(self._file(name), rows, dtype, shape)
+        history.load_state_dict({name[8:]: value for name, value in state.items() if name.startswith("history_")})
+        set_rng_state(state)
+        return {name: value for name, value in state.items() if not name.startswith(("history_", "rng_"))}
+
+    def save(self, i, history, force=False, **state):
+        """Save the state after iteration i, if a checkpoint is due (or force is set)"""
+        if (i + 1) % self.every and not force:
+            return
+        history_state = history.state_dict(skip={name: rows for name, (rows, _, _) in self.rows.items()})
+        arrays = {}
+        for name, value in history_state.items():
+            if name in history.appended or name.startswith("telemetry_"):
+                # the new rows go to the end of the file (a fresh one on the first save)
+                rows, dtype, shape = self.rows.get(name, [0, value.dtype.str, list(value.shape[1:])])
+                append_rows(self._file(name), value.astype(dtype), new=not rows)
+                self.rows[name] = [rows + len(value), dtype, shape]
+            else:
+                arrays["history_" + name] = value
+        arrays["appended"] = np.array(json.dumps(self.rows))
+        arrays.update(rng_state())
+        arrays.update(state)
+        save_npz(self.path, **arrays)
@@ -33,17 +33,28 @@ class View3D:
 
 
 class DroneViewer:
-
-    def __init__(self, flight_path, reference, rate=50, view_rotate=0.2):        
+    """Animate a flight.
+    flight_path, reference: (T, 3) arrays, or paths of .npy files (see record),
+                            which are memory mapped rather than loaded
+    rate: steps per second
+    view_rotate: degrees the view turns each frame
+    trail: number of recent reference points drawn as the path (all of them if None)
+    """
+    def __init__(self, flight_path, reference, rate=50, view_rotate=0.2, trail=None):        
         self.drone_pts = np.array([[-0.1,-0.1,0], [-0.1, 0.1, 0], [0.1,0.1,0], [0.1, -0.1, 0]]) * np.array([3,4,3])
         self.ground_pts = np.array([[-10,-10,0], [-10, 10, 0], [10,10,0], [10, -10, 0]]) * np.array([2,2,2])
         
 
         self.t = 0
+        if isinstance(flight_path, str):
+            flight_path = np.load(flight_path, mmap_mode="r")
+        if isinstance(reference, str):
+            reference = np.load(reference, mmap_mode="r")
         self.flight_path = flight_path
         self.reference = reference
         self.rate = rate
         self.view_rotate = view_rotate
+        self.trail = trail
         canvas = tkanvas.TKanvas(w=800, h=600, tick_fn=self.rotate, draw_fn=self.draw)
         self.v = View3D(canvas.w, canvas.h)
         self.v.camera[3,2] = -1
@@ -91,8 +102,9 @@ class DroneViewer:
         ref_pos = self.v.project(ref)
         ctr_pos = self.v.project(operator)
         
-        path = self.v.project(self.reference[0:self.t])
-        shadow_path = self.v.project(self.reference[0:self.t]*np.array([1,1,0]))
+        first = 0 if self.trail is None else max(0, self.t - self.trail)
+        path = self.v.project(self.reference[first:self.t])
+        shadow_path = self.v.project(self.reference[first:self.t]*np.array([1,1,0]))
         kanvas.polygon(path, outline='blue', fill='')     
         kanvas.polygon(shadow_path, outline='darkgreen', fill='')  
         kanvas.circle(drone_pos[0,0], drone_pos[0,1], 4, fill='orange')     
@@ -116,27 +128,169 @@ def pid_controller(vec, n_dim=3):
         old_error[:] = error        
         return p * error + i * i_state + d * deriv
     return controller
+
+
+class PIDBank:
+    """A bank of N PID controllers, evaluated together as arrays;
+    one call gives the control inputs of every controller, for simulate_batch.
+    Without limits, each row behaves exactly like pid_controller(gains[k]).
+    gains: (N, 3) array of (p, i, d) gains, one row per controller
+    n_dim: dimension of the controlled state
+    i_limit: if given, the integrator state is clamped to [-i_limit, i_limit]
+             (anti-windup)
+    out_limit: if given, the outputs are clamped to [-out_limit, out_limit]
+    """
+    def __init__(self, gains, n_dim=3, i_limit=None, out_limit=None):
+        self.gains = np.atleast_2d(np.asarray(gains, dtype=float))
+        # (N, 1) columns, to broadcast against (N, n_dim) errors
+        self.p, self.i, self.d = self.gains[:, 0:1], self.gains[:, 1:2], self.gains[:, 2:3]
+        self.n_dim = n_dim
+        self.i_limit = i_limit
+        self.out_limit = out_limit
+        self.reset()
+
+    def reset(self):
+        self.i_state = np.zeros((len(self.gains), self.n_dim))
+        self.old_error = np.zeros((len(self.gains), self.n_dim))
+
+    def __call__(self, state, reference):
+        error = reference - state
+        self.i_state += error
+        if self.i_limit is not None:
+            np.clip(self.i_state, -self.i_limit, self.i_limit, out=self.i_state)
+        deriv = error - self.old_error
+        self.old_error[:] = error
+        out = self.p * error + self.i * self.i_state + self.d * deriv
+        if self.out_limit is not None:
+            np.clip(out, -self.out_limit, self.out_limit, out=out)
+        return out
+
     
-def simulate(controller, reference, rate=50):
+def simulate(controller, reference, rate=50, rng=None, abort=None, out=None):
     ## If you are looking at this and thinking "this is totally unrealistic",
     ## you are correct. It isn't very realistic. 
-    
-    ts = np.arange(len(reference)) / rate
-    disturbance = np.array([np.cos(ts*0.035), np.sin(ts*0.02), np.cos(ts*0.05)]).T + np.array([-0.1,4,0.0])  
+    # simulate_batch for a single drone, stepped in place in preallocated
+    # buffers; the controller is passed a view of the position, so it must
+    # not keep it between calls
+    state_update, control_update, disturbance_update, gravity_force, drone_thrust = _drone_model()
+    if rng is not None:
+        rng = [np.random.default_rng(rng)]
+    xs = np.empty((len(reference), 3)) if out is None else out
+    x = np.zeros(9)
+    x_next = np.empty(9)
+    control = np.empty(9)
+    inp = np.empty(3)
+    position, position_next = x[0:3], x_next[0:3]
+    for i in range(len(reference)):
+        if i % _FORCING_BLOCK == 0:
+            forcing = _forcing_block(i, min(i + _FORCING_BLOCK, len(reference)), 1, rate, rng,
+                                     disturbance_update, gravity_force)[:, 0]
+        # limit thrust
+        np.clip(controller(position, reference[i]), -drone_thrust, drone_thrust, out=inp)
+        force = forcing[i % _FORCING_BLOCK]
+        if x[2] < 0.05:
+            # no disturbance on ground
+            force = gravity_force
+            x[3:5] *= 0.2 # extreme drag on ground
+            x[2] = max(x[2], 0)
+        if i:
+            # landing also clamps the height recorded on the previous step
+            xs[i-1,2] = x[2]
+        np.matmul(x, state_update, out=x_next)
+        np.matmul(inp, control_update, out=control)
+        x_next += control
+        x_next += force
+        x, x_next = x_next, x
+        position, position_next = position_next, position
+        xs[i] = position
+        if abort is not None and np.all(abort(i, xs[i:i+1], reference[i])):
+            return xs[:i+1]
+    return xs
+
+
+def record(controller, reference, path, rate=50, rng=None):
+    """simulate, writing the flight path straight into a .npy file at path
+    as it is flown, so that long flights never have to fit in memory.
+    Returns the flight as a read-only memory map; DroneViewer can replay
+    it, or it can be opened again later with np.load(path, mmap_mode="r")"""
+    flight = np.lib.format.open_memmap(path, mode="w+", dtype=float, shape=(len(reference), 3))
+    simulate(controller, reference, rate, rng, out=flight)
+    flight.flush()
+    del flight
+    return np.load(path, mmap_mode="r")
+
+
+class ErrorBound:
+    """Abort criterion for simulate, which stops a flight once it can no
+    longer beat a given loss, or once it has flown off.
+    length: number of steps in the full flight
+    bound: stop once the squared error summed so far exceeds bound * length;
+           the mean squared error of the full flight would be above bound
+    max_distance: stop once a drone is further than this from the reference
+    A drone stays stopped once either is hit (see .stopped). Works per drone, so it can be used with simulate_batch too.
+    """
+    def __init__(self, length, bound=np.inf, max_distance=None):
+        self.length = length
+        self.bound = bound
+        self.max_distance = max_distance
+        self.total = 0.0
+        self.error = 0.0
+        self.steps = 0
+        self.stopped = False
+
+    def __call__(self, i, positions, reference):
+        self.error = np.mean((positions - reference)**2, axis=-1)
+        self.total = self.total + self.error
+        self.steps = i + 1
+        stop = self.total > self.bound * self.length
+        if self.max_distance is not None:
+            stop = stop | (3 * self.error > self.max_distance**2)
+        # a drone that flew off stays stopped, even if it comes back
+        self.stopped = self.stopped | stop
+        return self.stopped
+
+    def penalty(self):
+        """The mean squared error, with the error at the last step
+        carried on to the end of the flight"""
+        return (self.total + (self.length - self.steps) * self.error) / self.length
 
-    x = np.zeros(9,)
+
+def simulate_bounded(controller, reference, bound=np.inf, max_distance=None, rate=50, rng=None):
+    """simulate, but stop as soon as the flight can no longer reach a mean
+    squared tracking error below bound, or strays more than max_distance
+    from the reference (see ErrorBound).
+    Returns the trajectory, shortened if the flight was stopped, and its
+    mean squared error; for a stopped flight this is a penalty instead,
+    which is above bound when the bound was what stopped it.
+    """
+    criterion = ErrorBound(len(reference), bound, max_distance)
+    flight = simulate(controller, reference, rate, rng, abort=criterion)
+    if len(flight) == len(reference):
+        return flight, np.mean((flight - reference)**2)
+    return flight, float(criterion.penalty()[0])
+
+
+def spawn_rngs(rng, n):
+    """n independent random streams spawned from rng, which can be
+    a seed, a SeedSequence or a Generator"""
+    return np.random.default_rng(rng).spawn(n)
+
+
+# number of steps of noise generated at a time, which bounds the memory
+# simulate_batch needs beyond its output, however long the flight
+_FORCING_BLOCK = 4096
+
+
+def _drone_model():
+    # the update of the drone, shared by simulate and simulate_batch
     dt = 0.002    
     drone_thrust = 55
-    noise = 15
     air_resistance = 0.99
     gravity = 0.08
     # define the dynamics, observation, control and disturbance matrices
     dynamics = np.diag(np.ones(9), 0) + np.diag(np.ones(6), 3)*dt
-        
     
-    observe_matrix = np.array([[1,0,0,0,0,0,0,0,0], 
-                               [0,1,0,0,0,0,0,0,0], 
-                               [0,0,1,0,0,0,0,0,0], ]).T
+    # the drone observes its position, x[:,0:3]
     
     c_gain = 0.1
     control_matrix = np.array([[0,0,0, c_gain,0,0, 0,0,0], 
@@ -149,23 +303,91 @@ def simulate(controller, reference, rate=50):
                                    [0,0,0,d_gain,0,0,0,0,0],
                                     [0,0,0,0,d_gain,0,0,0,0]
                                   ]).T
-    xs = []
+    # air resistance and gravity follow every update, so they are folded
+    # into the matrices once: x <- x @ state_update + inp @ control_update + forcing[i]
+    drag = np.diag([1,1,1, air_resistance,air_resistance,air_resistance, 1,1,1])
+    state_update = (drag @ dynamics).T
+    control_update = (drag @ control_matrix).T
+    disturbance_update = (drag @ disturbance_matrix).T
+    gravity_force = np.zeros(9)
+    gravity_force[8] = -gravity
+    return state_update, control_update, disturbance_update, gravity_force, drone_thrust
+
+
+def _forcing_block(start, stop, n, rate, rng, disturbance_update, gravity_force, noise=15):
+    # the (stop - start, n, 9) disturbance and noise of steps start..stop-1,
+    # generated in one go; drawing block by block gives the same numbers
+    # as drawing all at once
+    ts = np.arange(start, stop) / rate
+    disturbance = np.array([np.cos(ts*0.035), np.sin(ts*0.02), np.cos(ts*0.05)]).T + np.array([-0.1,4,0.0])  
+    if rng is None:
+        noises = np.random.normal(0,noise, (stop - start, n, 3))
+    else:
+        noises = np.stack([r.normal(0,noise, (stop - start, 3)) for r in rng], axis=1)
+    return (disturbance[:,None,:] + noises) @ disturbance_update + gravity_force
+
+
+def simulate_batch(controller, reference, n, rate=50, rng=None, abort=None, out=None):
+    """Fly n drones at once, all following the same reference.
+    controller: either a function taking the (n, 3) positions of all the
+                drones and the (3,) reference, and returning (n, 3) control
+                inputs (such as a PIDBank), or a list of n controllers as
+                used by simulate
+    reference: (T, 3) reference positions
+    n: number of drones
+    rng: None to draw the noise from the global numpy RNG; a seed or
+         Generator, from which each drone gets its own spawned stream;
+         or a list of n Generators, one per drone. Drone k's noise then
+         only depends on its own stream, so it is identical to that of
+         simulate(..., rng=streams[k]), whatever else is in the batch; the
+         trajectories agree to rounding (the batched arithmetic can differ
+         in the last bits).
+    abort(i, positions, reference): optional function called after each step
+         with the (n, 3) positions and the reference at that step; returns
+         a flag for each drone (or one for all) saying whether to stop.
+         The flights end once every drone has been stopped.
+    out: optional (n, T, 3) array to write the trajectories into, such as
+         a memory map (see record); a new array by default
+    Returns the (n, T, 3) trajectories; each drone gets its own noise.
+    If the flights were stopped early, T is the number of steps flown.
+    """
+    if not callable(controller):
+        controllers = controller
+        controller = lambda states, ref: np.array([c(state, ref) for c, state in zip(controllers, states)])
+
+    x = np.zeros((n, 9))
+    state_update, control_update, disturbance_update, gravity_force, drone_thrust = _drone_model()
+    if rng is not None and not isinstance(rng, (list, tuple)):
+        rng = spawn_rngs(rng, n)
+    
+    xs = np.empty((n, len(reference), 3)) if out is None else out
+    x_next = np.empty_like(x)
     for i in range(len(reference)):
+        if i % _FORCING_BLOCK == 0:
+            forcing = _forcing_block(i, min(i + _FORCING_BLOCK, len(reference)), n, rate, rng,
+                                     disturbance_update, gravity_force)
         
-        inp = controller(x @ observe_matrix, reference[i,:])
+        inp = controller(x[:,0:3].copy(), reference[i,:])
         # limit thrust
-        inp = np.clip(inp,-drone_thrust,drone_thrust)
-        
-        d = disturbance[i] + np.random.normal(0,noise, disturbance[i].shape)
-        # no disturbance on ground
-        if x[2]<0.05:
-            d *= 0
-            x[3:5] *= 0.2 # extreme drag on ground
-            x[2] = np.maximum(x[2],0)
-        x = dynamics @ x + control_matrix @ inp + disturbance_matrix @  d
+        inp = np.minimum(np.maximum(inp,-drone_thrust),drone_thrust)
         
-            
-        x[3:6] *= air_resistance # air resistance
-        x[8] -= gravity # gravity
-        xs.append(x)
-    return np.array(xs)[:,0:3]
\ No newline at end of file
+        force = forcing[i % _FORCING_BLOCK]
+        ground = x[:,2]<0.05
+        if np.count_nonzero(ground):
+            # no disturbance on ground
+            force = force.copy()
+            force[ground] = gravity_force
+            x[ground,3:5] *= 0.2 # extreme drag on ground
+            x[ground,2] = np.maximum(x[ground,2],0)
+        if i:
+            # landing also clamps the height recorded on the previous step
+            xs[:,i-1,2] = x[:,2]
+        # row vectors, so the matrices are applied from the right
+        np.matmul(x, state_update, out=x_next)
+        x_next += inp @ control_update
+        x_next += force
+        x, x_next = x_next, x
+        xs[:,i] = x[:,0:3]
+        if abort is not None and np.all(abort(i, xs[:,i], reference[i])):
+            return xs[:,:i+1]
+    return xs
\ No newline at end of file
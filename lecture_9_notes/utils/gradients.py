@@ -0,0 +1,76 @@
+import numpy as np
+
+# default step sizes for each scheme, balancing truncation against rounding error
+_default_h = {"forward": 1.5e-8, "central": 6e-6, "complex": 1e-20}
+
+
+class FiniteDifference:
+    """Numerical gradient of a loss function, for when there is no dL.
+    L: loss function
+    h: step size (a sensible default for the scheme if None)
+    scheme: "forward": d evaluations, plus the loss at theta itself (cached)
+            "central": 2d evaluations, more accurate
+            "complex": complex step, d evaluations, accurate to machine
+                       precision; L must accept complex theta
+    vectorized: if True, L receives all the perturbed points at once, as
+                a (n, d) array, and must return a (n,) vector of losses
+    executor: optional concurrent.futures executor to evaluate the
+              perturbed points on, if L is not vectorized
+
+    The object is the gradient function; use its loss method as L, e.g.
+        fd = FiniteDifference(L)
+        gradient_descent(fd.loss, fd, theta_0, delta)
+    so the loss at theta is shared between the step and the gradient.
+    """
+    def __init__(self, L, h=None, scheme="central", vectorized=False, executor=None):
+        self.L = L
+        self.h = h or _default_h[scheme]
+        self.scheme = scheme
+        self.vectorized = vectorized
+        self.executor = executor
+        self.evals = 0
+        self._theta = None
+        self._loss = None
+
+    def _evaluate(self, thetas):
+        self.evals += len(thetas)
+        if self.vectorized:
+            losses = self.L(thetas)
+        elif self.executor is not None:
+            losses = list(self.executor.map(self.L, thetas))
+        else:
+            losses = [self.L(theta) for theta in thetas]
+        return np.asarray(losses)
+
+    def _cached(self, theta):
+        return self._theta is not None and self._theta.shape == theta.shape and np.array_equal(self._theta, theta)
+
+    def _cache(self, theta, loss):
+        self._theta, self._loss = theta.copy(), loss
+
+    def loss(self, theta):
+        """L(theta), remembering the result for the next gradient"""
+        theta = np.asarray(theta, dtype=float)
+        if not self._cached(theta):
+            self._cache(theta, self._evaluate(theta[None])[0])
+        return self._loss
+
+    def __call__(self, theta):
+        theta = np.asarray(theta, dtype=float)
+        d, h = theta.size, self.h
+        # one perturbation along each dimension
+        steps = np.eye(d).reshape((d,) + theta.shape) * h
+        if self.scheme == "central":
+            losses = self._evaluate(np.concatenate([theta + steps, theta - steps]))
+            grad = (losses[:d] - losses[d:]) / (2 * h)
+        elif self.scheme == "complex":
+            grad = np.imag(self._evaluate(theta + 1j * steps)) / h
+        else:
+            if self._cached(theta):
+                losses = self._evaluate(theta + steps)
+            else:
+                # evaluate theta itself in the same batch
+                losses = self._evaluate(np.concatenate([theta + steps, theta[None]]))
+                self._cache(theta, losses[d])
+            grad = (losses[:d] - self._loss) / h
+        return np.real(grad).reshape(theta.shape)
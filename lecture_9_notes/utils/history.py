@@ -1,3 +1,4 @@
+import json
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -49,7 +50,7 @@ def linear_regression_plot(res, gradient, offset, x, y, opt_title=""):
     fig.suptitle("{opt_title} over possible line configurations".format(opt_title=opt_title))
 
     ax = fig.add_subplot(3,1,3)
-    ax.plot(res.all_loss, label="History")
+    ax.plot(res.all_iters, res.all_loss, label="History")
     ax.plot(res.best_iters, res.best_losses, 'o', label="Lowest so far")
     ax.legend()
     ax.set_xlabel("Iteration")
@@ -59,43 +60,326 @@ def linear_regression_plot(res, gradient, offset, x, y, opt_title=""):
 
                  
 
+def _grow(buf, n):
+    # return buf, or a copy of it with room for at least n rows;
+    # capacity doubles each time, so appending is O(1) amortised
+    if n <= len(buf):
+        return buf
+    grown = np.empty((max(n, 2 * len(buf)),) + buf.shape[1:], dtype=buf.dtype)
+    grown[:len(buf)] = buf
+    return grown
+
+
 class History:
-    def __init__(self):
-        self.all_theta = []
-        self.all_loss = []
-        self.best_thetas = []
-        self.best_losses = []
-        self.best_iters = []
-        self.all_best = []
+    # the arrays of state_dict that only ever grow at the end, so a
+    # checkpoint only has to write their new rows (see utils.checkpoint)
+    appended = ("theta", "loss", "trace", "is_best", "best_theta", "best_loss", "best_iter")
+
+    def __init__(self, capacity=1024):
+        # everything is stored in preallocated arrays that grow as needed;
+        # the theta buffers are allocated once the first theta is seen
+        self._theta = None
+        self._loss = np.empty(capacity)
+        self._trace = np.empty(capacity)
+        self._is_best = np.empty(capacity, dtype=bool)
+        self._best_theta = None
+        self._best_loss = np.empty(64)
+        self._best_iter = np.empty(64, dtype=int)
+        self.n_best = 0
+        self.n_kept = 0
         self.best = np.inf
         self.best_theta = None
-        self.loss_trace = []
+        self.loss_change = np.inf
+        self.telemetry = {}
         self.iters = 0
-        
+
+    # the filled part of each buffer, as views
+    @property
+    def all_theta(self):
+        return np.empty(0) if self._theta is None else self._theta[:self.n_kept]
+
+    @property
+    def all_loss(self):
+        return self._loss[:self.n_kept]
+
+    @property
+    def loss_trace(self):
+        return self._trace[:self.n_kept]
+
+    @property
+    def all_best(self):
+        return self._is_best[:self.n_kept]
+
+    @property
+    def all_iters(self):
+        return np.arange(1, self.n_kept + 1)
+
+    @property
+    def best_thetas(self):
+        return np.empty(0) if self._best_theta is None else self._best_theta[:self.n_best]
+
+    @property
+    def best_losses(self):
+        return self._best_loss[:self.n_best]
+
+    @property
+    def best_iters(self):
+        return self._best_iter[:self.n_best]
+    
+    def _allocate(self, shape):
+        self._theta = np.empty((len(self._loss),) + shape)
+        self._best_theta = np.empty((len(self._best_loss),) + shape)
+
+    def _add_best(self, thetas, losses, iters):
+        n = self.n_best + len(losses)
+        if n > len(self._best_loss):
+            self._best_theta = _grow(self._best_theta, n)
+            self._best_loss = _grow(self._best_loss, n)
+            self._best_iter = _grow(self._best_iter, n)
+        self._best_theta[self.n_best:n] = thetas
+        self._best_loss[self.n_best:n] = losses
+        self._best_iter[self.n_best:n] = iters
+        self.n_best = n
+        self.best = self._best_loss[n - 1]
+        self.best_theta = self._best_theta[n - 1]
     
     def track(self, theta, loss, force=False):
-        self.all_theta.append(theta)
-        self.all_loss.append(loss)
+        theta = np.asarray(theta, dtype=float)
+        if self._theta is None:
+            self._allocate(theta.shape)
         self.iters += 1
         is_best = False
         if loss<self.best or force:
-            self.best = loss
-            self.best_theta = theta
-            self.best_losses.append(self.best)
-            self.best_thetas.append(self.best_theta)
-            self.best_iters.append(self.iters)
+            self._add_best(theta[None], [loss], [self.iters])
             is_best = True
-        self.loss_trace.append(self.best)
-        self.all_best.append(is_best)
+        if self.iters > 1:
+            self.loss_change = loss - self._last_loss
+        self._last_loss = loss
+        self._record(theta, loss, self.best, is_best)
         return is_best
-    
+
+    def track_many(self, thetas, losses, is_best=None):
+        """Track a block of proposals at once, as if track() was called on each.
+        is_best: optional boolean mask of the proposals that become the new best
+                 (as with force=True), used as given; if None, it is worked out
+                 from the running minimum of the losses
+        """
+        thetas = np.asarray(thetas, dtype=float)
+        losses = np.asarray(losses, dtype=float)
+        if len(losses) == 0:
+            return np.zeros(0, dtype=bool)
+        if self._theta is None:
+            self._allocate(thetas.shape[1:])
+        if is_best is None:
+            # fmin skips NaN, so a NaN loss is never best, as in track()
+            running = np.fmin.accumulate(np.concatenate([[self.best], losses]))
+            is_best = losses < running[:-1]
+        else:
+            is_best = np.asarray(is_best, dtype=bool)
+        # the best so far is the loss at the last best proposal
+        last = np.maximum.accumulate(np.where(is_best, np.arange(len(losses)), -1))
+        trace = np.where(last >= 0, losses[last], self.best)
+        start = self.iters
+        self.iters += len(losses)
+        best = np.flatnonzero(is_best)
+        if len(best):
+            self._add_best(thetas[best], losses[best], start + best + 1)
+        if self.iters > 1:
+            previous = self._last_loss if len(losses) == 1 else losses[-2]
+            self.loss_change = losses[-1] - previous
+        self._last_loss = losses[-1]
+        self._record_many(thetas, losses, trace, is_best)
+        return is_best
+
+    def log(self, **values):
+        """Record per-iteration diagnostics, e.g. o.log(grad_norm=...);
+        each name becomes an array attribute when the History is finalised"""
+        for name, value in values.items():
+            self.telemetry.setdefault(name, []).append(value)
+
+    def _record(self, theta, loss, trace, is_best):
+        # keep every proposal
+        n = self.n_kept = self.iters
+        if n > len(self._loss):
+            self._grow_all(n)
+        self._write(n - 1, theta, loss, trace, is_best)
+
+    def _record_many(self, thetas, losses, trace, is_best):
+        n = self.iters
+        if n > len(self._loss):
+            self._grow_all(n)
+        self._write(slice(self.n_kept, n), thetas, losses, trace, is_best)
+        self.n_kept = n
+
+    def _grow_all(self, n):
+        self._theta = _grow(self._theta, n)
+        self._loss = _grow(self._loss, n)
+        self._trace = _grow(self._trace, n)
+        self._is_best = _grow(self._is_best, n)
+
+    def _write(self, slot, theta, loss, trace, is_best):
+        self._theta[slot] = theta
+        self._loss[slot] = loss
+        self._trace[slot] = trace
+        self._is_best[slot] = is_best
+
+    def state_dict(self, skip=None):
+        """Everything tracked so far, as a dict of arrays (see utils.checkpoint).
+        skip: optional {name: rows} of the appended arrays (or telemetry_<name>)
+              whose first rows to leave out, as they are already saved"""
+        skip = skip or {}
+        state = {"loss": self.all_loss, "trace": self.loss_trace, "is_best": self.all_best,
+                 "best_loss": self.best_losses, "best_iter": self.best_iters,
+                 "counts": np.array([self.iters, self.n_kept, self.n_best]),
+                 "last": np.array([self.best, self.loss_change, getattr(self, "_last_loss", np.nan)])}
+        if self._theta is not None:
+            state["theta_shape"] = np.array(self._theta.shape[1:], dtype=int)
+            state["theta"] = self.all_theta
+            state["best_theta"] = self.best_thetas
+        for name in self.appended:
+            if name in state and skip.get(name):
+                state[name] = state[name][skip[name]:]
+        for name, values in self.telemetry.items():
+            state["telemetry_" + name] = np.array(values[skip.get("telemetry_" + name, 0):])
+        return state
+
+    def load_state_dict(self, state):
+        """Restore a History saved with state_dict"""
+        self.iters, self.n_kept, self.n_best = (int(count) for count in state["counts"])
+        self.best, self.loss_change, self._last_loss = (float(value) for value in state["last"])
+        if "theta_shape" in state:
+            self._allocate(tuple(state["theta_shape"]))
+            self._grow_all(self.n_kept)
+            self._best_theta = _grow(self._best_theta, self.n_best)
+            self._best_loss = _grow(self._best_loss, self.n_best)
+            self._best_iter = _grow(self._best_iter, self.n_best)
+            self._write(slice(0, self.n_kept), state["theta"], state["loss"], state["trace"], state["is_best"])
+            self._best_theta[:self.n_best] = state["best_theta"]
+            self._best_loss[:self.n_best] = state["best_loss"]
+            self._best_iter[:self.n_best] = state["best_iter"]
+            if self.n_best:
+                self.best_theta = self._best_theta[self.n_best - 1]
+        self.telemetry = {name[10:]: list(values) for name, values in state.items() if name.startswith("telemetry_")}
+
     def finalise(self):
-        self.all_theta = np.array(self.all_theta)
-        self.all_loss = np.array(self.all_loss)
-        self.best_losses = np.array(self.best_losses)
-        self.best_thetas = np.array(self.best_thetas)
-        self.best_iters = np.array(self.best_iters)
+        # nothing to copy; the public attributes are already array views
         self.theta = np.array(self.best_theta)
         self.loss = np.array(self.best)
-        self.loss_trace = np.array(self.loss_trace)
-        return self
\ No newline at end of file
+        for name, values in self.telemetry.items():
+            setattr(self, name, np.array(values))
+        return self
+
+
+class StreamingHistory(History):
+    """History for very long runs: the best-so-far trajectory is kept
+    exactly, but only a bounded sample of all the proposals is kept.
+    Only strict improvements count as best: forced updates that don't
+    improve on the best (such as the uphill moves simulated_anneal accepts)
+    are only marked in the sampled trace, so best and theta are the lowest
+    loss seen, rather than the last forced one as in History.
+    max_trace: number of proposals kept; this is the memory ceiling,
+               about max_trace * (d + 4) numbers, plus the improvements
+    mode: "reservoir" keeps a uniform random sample of all proposals;
+          "decimate" keeps the early proposals densely and thins out the
+          later ones, so the kept iterations are roughly log-spaced
+    seed: seed for the reservoir sampling
+    """
+    # the sample is rewritten in place, but it is bounded by max_trace
+    appended = ("best_theta", "best_loss", "best_iter")
+
+    def __init__(self, max_trace=10000, mode="reservoir", seed=None):
+        super().__init__(capacity=max_trace)
+        self.max_trace = max_trace
+        self.mode = mode
+        self._iter = np.empty(max_trace, dtype=int)
+        self._stride = 1
+        # sampling uses its own RNG, so the optimiser's random stream is untouched
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def all_iters(self):
+        return self._iter[:self.n_kept]
+
+    def _add_best(self, thetas, losses, iters):
+        # keep only the strict improvements, so forced updates can't grow the buffers
+        losses = np.asarray(losses, dtype=float)
+        running = np.fmin.accumulate(np.concatenate([[self.best], losses]))
+        improved = losses < running[:-1]
+        if np.any(improved):
+            super()._add_best(np.asarray(thetas)[improved], losses[improved], np.asarray(iters)[improved])
+
+    def _record(self, theta, loss, trace, is_best, iteration=None):
+        iteration = iteration or self.iters
+        if self.mode == "reservoir":
+            # Algorithm R: proposal k replaces a random slot with probability max_trace/k
+            if self.n_kept < self.max_trace:
+                slot = self.n_kept
+                self.n_kept += 1
+            else:
+                slot = self._rng.integers(iteration)
+                if slot >= self.max_trace:
+                    return
+        else:
+            if self.n_kept and iteration - self._iter[self.n_kept - 1] < self._stride:
+                return
+            if self.n_kept == self.max_trace:
+                self._thin()
+            slot = self.n_kept
+            self.n_kept += 1
+        self._write(slot, theta, loss, trace, is_best)
+        self._iter[slot] = iteration
+
+    def _record_many(self, thetas, losses, trace, is_best):
+        start = self.iters - len(losses)
+        iteration = start + 1 + np.arange(len(losses))
+        if self.mode == "reservoir":
+            # fill any empty slots in order, then sample the rest in one go
+            fill = min(len(losses), self.max_trace - self.n_kept)
+            slots = np.concatenate([self.n_kept + np.arange(fill), self._rng.integers(iteration[fill:])])
+            self.n_kept += fill
+            rows = np.flatnonzero(slots < self.max_trace)
+            # when a slot is hit twice, the later proposal wins
+            slots, last = np.unique(slots[rows][::-1], return_index=True)
+            rows = rows[::-1][last]
+            self._write(slots, thetas[rows], losses[rows], trace[rows], is_best[rows])
+            self._iter[slots] = iteration[rows]
+        else:
+            # jump straight to the next proposal far enough from the last kept one
+            j = 0
+            while j < len(losses):
+                if self.n_kept:
+                    j = max(j, self._iter[self.n_kept - 1] + self._stride - start - 1)
+                    if j >= len(losses):
+                        break
+                self._record(thetas[j], losses[j], trace[j], is_best[j], iteration[j])
+                j += 1
+
+    def _thin(self):
+        # keep the first half of the samples, and every other one of the rest
+        half = self.n_kept // 2
+        keep = np.concatenate([np.arange(half), np.arange(half, self.n_kept, 2)])
+        for buf in [self._theta, self._loss, self._trace, self._is_best, self._iter]:
+            buf[:len(keep)] = buf[keep]
+        self.n_kept = len(keep)
+        self._stride *= 2
+
+    def state_dict(self, skip=None):
+        state = super().state_dict(skip)
+        state["iter"] = self.all_iters
+        state["stride"] = np.array(self._stride)
+        state["rng"] = np.array(json.dumps(self._rng.bit_generator.state))
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self._iter[:self.n_kept] = state["iter"]
+        self._stride = int(state["stride"])
+        self._rng.bit_generator.state = json.loads(str(state["rng"]))
+
+    def finalise(self):
+        # put the reservoir back into iteration order
+        if self.n_kept:
+            order = np.argsort(self._iter[:self.n_kept])
+            for buf in [self._theta, self._loss, self._trace, self._is_best, self._iter]:
+                buf[:self.n_kept] = buf[order]
+        return super().finalise()
@@ -0,0 +1,50 @@
+import numpy as np
+
+# standard test functions for optimisers; theta is (..., d),
+# so each of these works on a single vector or on a batch of them
+
+
+def rosenbrock(theta):
+    """Long curved valley, minimum 0 at (1, 1, ..., 1)"""
+    theta = np.asarray(theta)
+    return np.sum(100 * (theta[..., 1:] - theta[..., :-1]**2)**2 + (1 - theta[..., :-1])**2, axis=-1)
+
+
+def rastrigin(theta):
+    """Regular grid of local minima, global minimum 0 at the origin"""
+    theta = np.asarray(theta)
+    return 10 * theta.shape[-1] + np.sum(theta**2 - 10 * np.cos(2 * np.pi * theta), axis=-1)
+
+
+def ackley(theta):
+    """Nearly flat outer region with a deep hole, minimum 0 at the origin"""
+    theta = np.asarray(theta)
+    d = theta.shape[-1]
+    return (-20 * np.exp(-0.2 * np.sqrt(np.sum(theta**2, axis=-1) / d))
+            - np.exp(np.sum(np.cos(2 * np.pi * theta), axis=-1) / d) + 20 + np.e)
+
+
+def pid_reference(n=500, rate=50):
+    """A slow figure-of-eight at 1m height, for the drone to follow"""
+    ts = np.arange(n) / rate
+    return np.stack([np.sin(ts * 0.5), np.sin(ts) * 0.5, np.ones_like(ts)], axis=1)
+
+
+def pid_loss(theta, reference=None, rng=None, bound=None, max_distance=None, budget=None):
+    """Mean squared tracking error of a drone flown by a PID controller
+    with gains theta = (p, i, d); rng seeds the flight's noise (see simulate).
+    bound, max_distance: stop flights early that can't get below bound,
+    or that stray too far, and return a penalty (see simulate_bounded)
+    budget: if given, only fly the first budget steps of the reference
+            (for successive_halving and hyperband)"""
+    # imported here, so the other functions don't need the drone's dependencies
+    from utils.drone import pid_controller, simulate, simulate_bounded
+    if reference is None:
+        reference = pid_reference()
+    if budget is not None:
+        reference = reference[:int(budget)]
+    if bound is not None or max_distance is not None:
+        bound = np.inf if bound is None else bound
+        return simulate_bounded(pid_controller(theta), reference, bound, max_distance, rng=rng)[1]
+    flight = simulate(pid_controller(theta), reference, rng=rng)
+    return np.mean((flight - reference)**2)
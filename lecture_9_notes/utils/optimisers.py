@@ -1,87 +1,341 @@
 from utils.history import History
+from utils.gradients import FiniteDifference
+from utils.parallel import BLOCK, evaluate, pool, submit, candidate_seeds, run_seed, _seeded_call
+from utils.checkpoint import Checkpoint
+from concurrent.futures import wait, FIRST_COMPLETED
 import numpy as np
-import itertools
+import bisect
+import functools
+import math
+import os
 
 
-def genetic_search(L, pop, guess_fn, mutation_fn, iters, keep=0.25):
+def genetic_search(L, pop, guess_fn, mutation_fn, iters, keep=0.25, vectorized=False,
+                   executor=None, workers=None, seed=None, chunksize=16,
+                   checkpoint=None, checkpoint_every=10):
+    """L: loss function
+    pop: number of individuals in the population
+    guess_fn: calling this should return a random individual
+    mutation_fn(theta): given a parameter vector, returns a mutated copy
+    iters: number of generations to run the optimisation for
+    keep: fraction of the population that survives to breed
+    vectorized: if True, L receives the whole (pop, d) population and must
+                return a (pop,) vector of losses, and mutation_fn receives
+                all the offspring at once as a (n, d) array
+    executor, workers, seed, chunksize: evaluate the individuals in parallel,
+                see random_search (not used in vectorized mode)
+    checkpoint: path of a .npz file to save the population, History and RNG
+                state to every checkpoint_every generations; if the file
+                already exists, the run resumes from it (see utils.checkpoint)
+    """
     o = History()
+    seed = run_seed(seed, executor, workers)
     # create the initial population randomly
     population = np.array([guess_fn() for i in range(pop)])
     d = len(guess_fn()) # store dimensionality of problem
     loss = np.zeros(pop)
+    start = 0
+    if checkpoint:
+        checkpoint = Checkpoint(checkpoint, checkpoint_every)
+        saved = checkpoint.resume(o)
+        if saved is not None:
+            population, start = saved["population"], int(saved["iteration"])
+            seed = int(saved["seed"]) if "seed" in saved else None
     
-    for i in range(iters):                
-        for j in range(pop):                        
-            # could also mutate *everyone* here
-            # this works better in asexual reproduction            
-            loss[j] = L(population[j])
+    with pool(executor, workers) as executor:
+        for i in range(start, iters):                
+            if vectorized:
+                loss = np.asarray(L(population), dtype=float)
+            else:
+                # could also mutate *everyone* here
+                # this works better in asexual reproduction            
+                loss = evaluate(L, population, executor, candidate_seeds(seed, i * pop, pop), chunksize)
             
-        # order by loss
-        order = np.argsort(loss)
-        loss = loss[order]
-        population = population[order]
+            # order by loss
+            order = np.argsort(loss)
+            loss = loss[order]
+            population = population[order]
         
-        # replicate top "keep" fraction of individuals
-        top = int(pop * keep)
-        for j in range(top, pop):
-            # sexual reproduction
-            mum = np.random.randint(0, top)
-            dad = np.random.randint(0, top)
-            chromosones = np.random.randint(0,2,d)  
-            
-            # select elements from each dimension randomly from mum and dad
-            population[j]  = mutation_fn(np.where(chromosones==0, population[mum], population[dad]))             
+            # replicate top "keep" fraction of individuals
+            top = int(pop * keep)
+            if vectorized:
+                # breed every child in one go
+                n = pop - top
+                mums = np.random.randint(0, top, n)
+                dads = np.random.randint(0, top, n)
+                chromosones = np.random.randint(0, 2, (n, d))
+                population[top:] = mutation_fn(np.where(chromosones==0, population[mums], population[dads]))
+            else:
+                for j in range(top, pop):
+                    # sexual reproduction
+                    mum = np.random.randint(0, top)
+                    dad = np.random.randint(0, top)
+                    chromosones = np.random.randint(0,2,d)  
+                
+                    # select elements from each dimension randomly from mum and dad
+                    population[j]  = mutation_fn(np.where(chromosones==0, population[mum], population[dad]))             
             
-        # track the best individual so far
-        o.track(population[0], loss[0])            
+            # track the best individual so far
+            o.track(population[0], loss[0])            
+            if checkpoint:
+                state = {"population": population, "iteration": i + 1}
+                if seed is not None:
+                    state["seed"] = seed
+                checkpoint.save(i, o, force=i == iters - 1, **state)
     return o.finalise()
 
 
-def grid_search(L, ranges, divs, maxiter=None):
+def _breed(members, keep, mutation_fn):
+    # cross two parents drawn from the top `keep` fraction of the sorted population
+    top = max(1, int(len(members) * keep))
+    mum = members[np.random.randint(0, top)]
+    dad = members[np.random.randint(0, top)]
+    chromosones = np.random.randint(0, 2, len(mum))
+    return mutation_fn(np.where(chromosones==0, mum, dad))
+
+
+def steady_state_genetic_search(L, pop, guess_fn, mutation_fn, iters, keep=0.25, in_flight=None,
+                                executor=None, workers=None, seed=None):
+    """Asynchronous genetic search: rather than waiting for a whole
+    generation, a new child is bred and sent off as soon as any evaluation
+    returns, and the returned individual takes the place of the worst one.
+    Workers never sit idle waiting for the slowest individual, which pays
+    off when the cost of L varies (e.g. drone flights that end on landing).
+    L: loss function
+    pop: number of individuals in the population
+    guess_fn: calling this should return a random individual
+    mutation_fn(theta): given a parameter vector, returns a mutated copy
+    iters: number of evaluations of L; the first pop are random guesses
+    keep: fraction of the population that breeds
+    in_flight: number of evaluations running at once (the number of workers by default)
+    executor, workers, seed: evaluate the individuals in parallel, see random_search;
+                with more than one worker, the order the results come back in
+                (and so the History) depends on timing
+    """
+    o = History()
+    seed = run_seed(seed, executor, workers)
+    # the population, kept sorted by loss as individuals arrive
+    losses, members = [], []
+    pending = {}
+    submitted = 0
+    with pool(executor, workers) as executor:
+        if in_flight is None:
+            in_flight = 1 if executor is None else (workers or os.cpu_count())
+        while pending or submitted < iters:
+            # keep the workers busy
+            while submitted < iters and len(pending) < in_flight:
+                if submitted < pop or not members:
+                    theta = guess_fn()
+                else:
+                    theta = _breed(members, keep, mutation_fn)
+                theta = np.asarray(theta, dtype=float)
+                future = submit(executor, _seeded_call, L, theta, candidate_seeds(seed, submitted, 1)[0])
+                pending[future] = theta
+                submitted += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                theta = pending.pop(future)
+                loss = future.result()
+                o.track(theta, loss)
+                # insert in order, and drop the worst if the population is full
+                j = bisect.bisect_right(losses, loss)
+                losses.insert(j, loss)
+                members.insert(j, theta)
+                if len(losses) > pop:
+                    losses.pop()
+                    members.pop()
+    return o.finalise()
+
+
+def grid_order(n, order="lexicographic", seed=None):
+    """Return a function mapping positions 0..n-1 in the walk over a grid
+    of n points to linear grid indices; every index is visited exactly once.
+    order: "lexicographic" walks the grid in itertools.product order;
+           "strided" jumps by a stride close to n / golden ratio, so that any
+           prefix of the walk is spread evenly over the whole grid;
+           "shuffled" uses a random affine permutation (a*k + c) mod n;
+           both need n < 2**32
+    seed: seed for the "shuffled" permutation
+    """
+    if order == "lexicographic":
+        return lambda k: k
+    # k * a must fit in 64 bits, so grids of up to 2**32 points are supported
+    if n >= 2**32:
+        raise ValueError("{} order needs a grid of fewer than 2**32 points, not {}".format(order, n))
+    if order == "strided":
+        a, c = int(n / 1.618033988749895), 0
+    else:
+        rng = np.random.default_rng(seed)
+        a, c = int(rng.integers(1, max(n, 2))), int(rng.integers(0, n))
+    # the multiplier must be coprime with n to give a permutation
+    a = max(a, 1)
+    while math.gcd(a, n) != 1:
+        a += 1
+    return lambda k: (k.astype(np.uint64) * np.uint64(a) + np.uint64(c)) % np.uint64(n)
+
+
+def grid_search(L, ranges, divs, maxiter=None, order="lexicographic", block=None, start=0,
+                executor=None, workers=None, seed=None, chunksize=16, history=None):
     """L: loss function
     ranges: Parameter ranges for each dimension (e.g. [[0,1], [-1,1], [0,2]])
-    divs: division per range
+    divs: division per range (one number for all ranges, or one per range)
+    maxiter: maximum number of grid points to evaluate
+    order: order to walk the grid in, see grid_order; "strided" or "shuffled"
+           spread a maxiter-limited search over the whole grid
+    block: if given, L receives (block, d) arrays of grid points
+           and must return a (block,) vector of losses
+    start: position in the walk to start from; a stopped search can be
+           resumed from its result's next_index
+    executor, workers, seed, chunksize: evaluate the grid points in parallel,
+                see random_search; seed also seeds the "shuffled" order,
+                which is otherwise drawn at random and kept as o.grid_seed
+    history: History to track into (e.g. a StreamingHistory for huge grids);
+             a new History by default
     """    
-    o = History()
-    divisions = [np.linspace(r[0], r[1], divs) for r in ranges]        
-    i  = 0
-    for theta in itertools.product(*divisions):                            
-        o.track(theta, L(np.array(theta)))
-        
-        i+=1
-        if maxiter and i>=maxiter:
-            break
+    o = history or History()
+    # a shuffled walk can only be resumed with the same seed; a made up one
+    # only seeds the order, so it doesn't reseed every evaluation of L
+    order_seed = seed
+    if order == "shuffled" and order_seed is None:
+        order_seed = np.random.randint(0, 2**31)
+    seed = run_seed(seed, executor, workers)
+    divisions = [np.linspace(r[0], r[1], div) for r, div in zip(ranges, np.broadcast_to(divs, len(ranges)))]
+    shape = tuple(len(division) for division in divisions)
+    n = int(np.prod(shape, dtype=np.int64))
+    stop = min(n, start + maxiter) if maxiter else n
+    index = grid_order(n, order, order_seed)
+    o.next_index = start
+    # the grid is generated block by block, never as a whole
+    with pool(executor, workers) as executor:
+        step = block or BLOCK
+        for pos in range(start, stop, step):
+            k = np.arange(pos, min(pos + step, stop))
+            coords = np.unravel_index(index(k), shape)
+            thetas = np.stack([division[c] for division, c in zip(divisions, coords)], axis=1)
+            if block:
+                losses = L(thetas)
+            else:
+                losses = evaluate(L, thetas, executor, candidate_seeds(seed, pos, len(k)), chunksize)
+            o.track_many(thetas, losses)
+            o.next_index = pos + len(k)
+    o.grid_seed = order_seed
     return o.finalise()
     
-def hill_climbing(L, guess_fn, neighbour_fn, iters):
+def hill_climbing(L, guess_fn, neighbour_fn, iters, history=None, bound=False):
     """
     L: loss function
     theta_0: initial guess
     neighbour_fn(theta): given a parameter vector, returns a random vector nearby
     iters: number of iterations to run the optimisation for
+    history: History to track into (e.g. a StreamingHistory for very long runs);
+             a new History by default
+    bound: if True, L is called as L(theta, bound=best loss so far), so it can
+           give up early on proposals that won't beat it (see pid_loss)
     """
-    o = History()
+    o = history or History()
     theta_0 = guess_fn()
     o.track(theta_0, L(theta_0))
     for i in range(iters):
         proposal = neighbour_fn(o.best_theta)
-        o.track(proposal, L(proposal))        
+        loss = L(proposal, bound=o.best) if bound else L(proposal)
+        o.track(proposal, loss)        
     return o.finalise()
     
     
-def random_search(L, sample_fn, iters):
+def random_search(L, sample_fn, iters, executor=None, workers=None, seed=None, chunksize=16, bound=False):
     """L: loss function
     sample_fn: calling this should draw one random sample from the parameter space
     iters: number of iterations to run the optimisation for
+    executor: optional concurrent.futures executor to evaluate L with
+              (L must then be picklable, e.g. a module level function)
+    workers: if no executor is given, evaluate L on a pool of this many processes
+    seed: if given, every evaluation of L runs with the global RNG seeded from
+          (seed, evaluation number), so the History is the same for any number
+          of workers, including a serial run
+    chunksize: number of candidates sent to a worker at a time
+    bound: if True, L is called as L(theta, bound=best loss so far), so it can
+           give up early on candidates that won't beat it (see pid_loss);
+           in parallel runs, the bound is the best at the start of each block
     """
     o = History()
-    for i in range(iters):
-        theta = sample_fn()        
-        o.track(theta, L(theta))    
+    seed = run_seed(seed, executor, workers)
+    with pool(executor, workers) as executor:
+        # candidates are drawn in blocks and evaluated together
+        block = BLOCK if executor is not None else 1
+        for i in range(0, iters, block):
+            thetas = [sample_fn() for j in range(i, min(i + block, iters))]
+            loss_fn = functools.partial(L, bound=o.best) if bound else L
+            losses = evaluate(loss_fn, thetas, executor, candidate_seeds(seed, i, len(thetas)), chunksize)
+            for theta, loss in zip(thetas, losses):
+                o.track(theta, loss)    
     return o.finalise()    
     
 
-def simulated_anneal(L, guess_fn, neighbour_fn, temperature_fn, iters):
+def successive_halving(L, sample_fn, n, max_budget, eta=3, rounds=None, history=None,
+                       executor=None, workers=None, seed=None, chunksize=16):
+    """Spend little on most candidates: evaluate n random candidates with a
+    small budget, keep the best 1/eta of them, give those eta times the
+    budget, and so on until the last round is run at max_budget.
+    L(theta, budget): loss function, evaluated with a given budget, e.g.
+                      pid_loss with budget = number of reference steps flown
+    sample_fn: calling this should draw one random sample from the parameter space
+    n: number of candidates in the first round
+    max_budget: budget of the last round
+    eta: fraction of candidates dropped, and factor the budget grows by, each round
+    rounds: number of rounds; by default enough to whittle n down to one
+    history: History to track into (hyperband shares one across its brackets)
+    executor, workers, seed, chunksize: evaluate the candidates in parallel,
+                see random_search
+    Every evaluation is tracked, and its budget logged as o.budget, but only
+    evaluations at max_budget can become the best.
+    """
+    o = history or History()
+    if rounds is None:
+        rounds = int(math.log(n, eta) + 1e-9) + 1
+    seed = run_seed(seed, executor, workers)
+    thetas = np.array([sample_fn() for i in range(n)])
+    with pool(executor, workers) as executor:
+        for k in range(rounds):
+            budget = max(1, int(round(max_budget * eta**(k - rounds + 1))))
+            losses = evaluate(functools.partial(L, budget=budget), thetas, executor,
+                              candidate_seeds(seed, o.iters, len(thetas)), chunksize)
+            # low budget losses aren't comparable with the final ones
+            o.track_many(thetas, losses, is_best=None if k == rounds - 1 else np.zeros(len(thetas), dtype=bool))
+            for theta in thetas:
+                o.log(budget=budget)
+            # promote the best fraction to the next round
+            thetas = thetas[np.argsort(losses)[:max(1, len(thetas) // eta)]]
+    return o.finalise()
+
+
+def hyperband(L, sample_fn, max_budget, min_budget=1, eta=3, history=None,
+              executor=None, workers=None, seed=None, chunksize=16):
+    """Hyperband: successive halving run several times ("brackets"), from
+    many candidates starting at min_budget down to a few evaluated at
+    max_budget only, as there is no telling in advance how aggressively
+    it is safe to stop candidates early.
+    L(theta, budget): loss function, see successive_halving
+    sample_fn: calling this should draw one random sample from the parameter space
+    max_budget, min_budget: largest and smallest budget to evaluate with
+    eta: see successive_halving
+    history: History to track into; a new History by default
+    executor, workers, seed, chunksize: evaluate the candidates in parallel,
+                see random_search
+    The total budget spent is o.budget.sum().
+    """
+    o = history or History()
+    s_max = int(math.log(max_budget / min_budget, eta) + 1e-9)
+    seed = run_seed(seed, executor, workers)
+    with pool(executor, workers) as executor:
+        for s in range(s_max, -1, -1):
+            n = int(math.ceil((s_max + 1) / (s + 1) * eta**s))
+            successive_halving(L, sample_fn, n, max_budget, eta, rounds=s + 1, history=o,
+                               executor=executor, seed=seed, chunksize=chunksize)
+    return o.finalise()
+
+
+def simulated_anneal(L, guess_fn, neighbour_fn, temperature_fn, iters, history=None,
+                     checkpoint=None, checkpoint_every=1000):
     """
     L: loss function
     theta_0: initial guess
@@ -90,13 +344,26 @@ def simulated_anneal(L, guess_fn, neighbour_fn, temperature_fn, iters):
     temperature_fn(iter): given an iteration,     
                         return the temperature schedule
     iters: number of iterations to run the optimisation for
+    history: History to track into (e.g. a StreamingHistory for very long runs);
+             a new History by default
+    checkpoint: path of a .npz file to save the current state, History and RNG
+                state to every checkpoint_every iterations; if the file
+                already exists, the run resumes from it (see utils.checkpoint)
     """
-    o = History()
-    theta_0 = guess_fn()
-    o.track(theta_0, L(theta_0))
-    state = theta_0.copy()
-    loss = L(theta_0)
-    for i in range(iters):
+    o = history or History()
+    saved = None
+    if checkpoint:
+        checkpoint = Checkpoint(checkpoint, checkpoint_every)
+        saved = checkpoint.resume(o)
+    if saved is not None:
+        state, loss, start = saved["state"], float(saved["loss"]), int(saved["iteration"])
+    else:
+        theta_0 = guess_fn()
+        o.track(theta_0, L(theta_0))
+        state = theta_0.copy()
+        loss = L(theta_0)
+        start = 0
+    for i in range(start, iters):
         proposal = neighbour_fn(state)        
         proposal_loss = L(proposal)                
         # climb if we can
@@ -114,19 +381,276 @@ def simulated_anneal(L, guess_fn, neighbour_fn, temperature_fn, iters):
                 loss, state = proposal_loss, proposal
             else:
                 o.track(proposal, proposal_loss)
+        if checkpoint:
+            checkpoint.save(i, o, force=i == iters - 1, state=state, loss=loss, iteration=i + 1)
     return o.finalise()
     
-def gradient_descent(L, dL, theta_0, delta, tol=1e-4, maxiter=None):
-    theta = np.array(theta_0) # copy theta_0    
+def _replica_exchange(state, loss, temperature, parity):
+    # try to swap the states of neighbouring chains (k, k+1), for every other k;
+    # swaps are accepted with the usual parallel tempering probability
+    k = np.arange(parity, len(loss) - 1, 2)
+    with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+        p = np.exp((loss[k] - loss[k + 1]) * (1 / temperature[k] - 1 / temperature[k + 1]))
+    k = k[np.random.uniform(0, 1, len(k)) < p]
+    swap = np.concatenate([k, k + 1])
+    state[swap] = state[np.concatenate([k + 1, k])]
+    loss[swap] = loss[np.concatenate([k + 1, k])]
+    return swap
+
+
+def simulated_anneal_chains(L, guess_fn, neighbour_fn, temperature_fn, iters, chains=8,
+                            ladder=None, exchange=None, block=256, history_factory=History):
+    """
+    Run several simulated annealing chains at once, as arrays.
+    L: vectorized loss function; receives a (chains, d) array of states
+       and must return a (chains,) vector of losses
+    guess_fn: function that should return an initial guess (called for each chain)
+    neighbour_fn(thetas): given a (chains, d) array of parameter vectors,
+                          returns an array of random vectors near each one
+    temperature_fn(iter): given an iteration,     
+                        return the temperature schedule
+    iters: number of iterations to run the optimisation for
+    chains: number of chains
+    ladder: optional (chains,) multipliers of the temperature, one per chain,
+            in increasing order (for parallel tempering); all 1 by default.
+            With a ladder, chain k accepts a worse proposal with probability
+            exp(-(increase in loss) / T), T = temperature_fn(i) * ladder[k],
+            as the replica exchange assumes; without one, each chain accepts
+            as simulated_anneal does
+    exchange: if given, every `exchange` iterations neighbouring chains on
+              the ladder try to swap states (replica exchange)
+    block: number of iterations buffered before they are tracked
+    history_factory: called to create the History of each chain, e.g.
+                     lambda: StreamingHistory(10000) for very long runs
+    Returns a list with the finalised History of each chain.
+    """
+    o = [history_factory() for k in range(chains)]
+    tempering = ladder is not None
+    ladder = np.ones(chains) if ladder is None else np.asarray(ladder, dtype=float)
+    state = np.array([guess_fn() for k in range(chains)])
+    loss = np.asarray(L(state), dtype=float)
+    # (rows, chains, ...) buffers, flushed into the histories every block steps;
+    # a swap adds a row that only the chains that swapped keep, hence the spare row
+    thetas = np.empty((block + 1,) + state.shape)
+    losses = np.empty((block + 1, chains))
+    accepted = np.empty((block + 1, chains), dtype=bool)
+    kept = np.ones((block + 1, chains), dtype=bool)
+    thetas[0], losses[0], accepted[0] = state, loss, True
+    n = 1
+    for i in range(iters):
+        if n >= block:
+            for k in range(chains):
+                rows = kept[:n, k]
+                o[k].track_many(thetas[:n, k][rows], losses[:n, k][rows], is_best=accepted[:n, k][rows])
+            kept[:] = True
+            n = 0
+        proposal = neighbour_fn(state)
+        proposal_loss = np.asarray(L(proposal), dtype=float)
+        temperature = temperature_fn(i) * ladder
+        # climb if we can, otherwise jump with probability given by how bad the jump is
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            if tempering:
+                p = np.exp(-(proposal_loss - loss) / temperature)
+            else:
+                p = np.exp(-(proposal_loss - loss)) * temperature
+        accept = (proposal_loss < loss) | (np.random.uniform(0, 1, chains) < p)
+        state = np.where(accept.reshape((-1,) + (1,) * (state.ndim - 1)), proposal, state)
+        loss = np.where(accept, proposal_loss, loss)
+        thetas[n], losses[n], accepted[n] = proposal, proposal_loss, accept
+        n += 1
+        if exchange and (i + 1) % exchange == 0:
+            # a chain that swaps moves to its new state after this iteration's proposal
+            swap = _replica_exchange(state, loss, temperature, (i // exchange) % 2)
+            if len(swap):
+                kept[n] = False
+                kept[n, swap] = True
+                thetas[n], losses[n], accepted[n] = state, loss, True
+                n += 1
+    for k in range(chains):
+        rows = kept[:n, k]
+        o[k].track_many(thetas[:n, k][rows], losses[:n, k][rows], is_best=accepted[:n, k][rows])
+    return [h.finalise() for h in o]
+    
+class MiniBatches:
+    """Shuffled epoch stream of mini-batches, for stochastic optimisation.
+    n: number of rows in the dataset
+    batch_size: rows per mini-batch; the rows left over at the end of an
+                epoch are dropped, and the next epoch is reshuffled
+    seed: seed for the shuffling
+    The loss then takes the form L(theta, idx), using only the rows idx of
+    the dataset, with idx=None meaning all of it (and likewise dL).
+    """
+    def __init__(self, n, batch_size, seed=None):
+        self.n = n
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.epoch = 0
+        self._order = self.rng.permutation(n)
+        self._pos = 0
+        self.idx = None
+
+    def next(self):
+        """Move on to the next mini-batch and return its indices"""
+        if self._pos + self.batch_size > self.n:
+            self.epoch += 1
+            self._order = self.rng.permutation(self.n)
+            self._pos = 0
+        self.idx = self._order[self._pos:self._pos + self.batch_size]
+        self._pos += self.batch_size
+        return self.idx
+
+    def bind(self, f):
+        """f(theta, idx) as a function of theta, on the current mini-batch"""
+        return lambda theta: f(theta, self.idx)
+
+
+def _first_order(L, theta_0, update, tol, maxiter, batches=None, eval_every=None, full_L=None):
+    # shared loop of the first-order optimisers;
+    # update(theta) returns the step to take, the gradient it used,
+    # and the loss after the step if it already knows it (or None)
+    if batches is not None and not maxiter:
+        raise ValueError("Stochastic optimisation needs maxiter to stop")
+    theta = np.array(theta_0, dtype=float) # copy theta_0    
     o = History()    
     i  = 0
-    # while the loss changes
-    while np.abs(o.loss_change)>tol:
-        # step along the derivative        
+    # while the loss changes (mini-batch losses are too noisy to tell)
+    while batches is not None or np.abs(o.loss_change)>tol:
         i+=1
-        theta += -delta * dL(theta)        
-        o.track(np.array(theta), L(theta))   
+        if batches is not None:
+            batches.next()
+        step, grad, loss = update(theta)
+        theta += step
+        if not eval_every:
+            o.track(np.array(theta), L(theta) if loss is None else loss)   
+        elif i % eval_every == 0:
+            o.track(np.array(theta), full_L(theta))
+        o.log(grad_norm=np.linalg.norm(grad), step_size=np.linalg.norm(step))
         if maxiter and i>=maxiter:
             break        
         
-    return o.finalise()    
\ No newline at end of file
+    return o.finalise()
+
+
+def _gradient(L, dL, batches=None):
+    # returns the loss and gradient to step with, and the full-data loss;
+    # in stochastic mode the first two only see the current mini-batch
+    full_L = L
+    if batches is not None:
+        full_data = L
+        full_L = lambda theta: full_data(theta, None)
+        L, dL = batches.bind(L), dL and batches.bind(dL)
+    # fall back to a numerical gradient if there is no dL
+    if dL is None:
+        dL = FiniteDifference(L)
+        # the cached loss can't be shared when the mini-batch keeps changing
+        if batches is None:
+            L = dL.loss
+    return L, dL, full_L
+
+
+def gradient_descent(L, dL, theta_0, delta, tol=1e-4, maxiter=None, batches=None, eval_every=None):
+    """
+    L: scalar loss function
+    dL: gradient of loss function w.r.t parameters; if None, a central
+        FiniteDifference of L is used (see utils.gradients for other schemes)
+    theta_0: starting point
+    delta: step size
+    tol: termination condition; 
+        when change in loss is less than tol, stop iterating
+    maxiter: maximum number of steps
+    batches: a MiniBatches stream for stochastic optimisation; L and dL then
+        take (theta, idx) and only see the current mini-batch idx, and the
+        optimiser runs for exactly maxiter steps
+    eval_every: if given, only every eval_every steps are tracked, with the
+        loss on the whole dataset, L(theta, None); otherwise every step is
+        tracked with the mini-batch loss
+    All the first-order optimisers log the gradient norm and step size of each
+    iteration, as the grad_norm and step_size arrays of the result.
+    """
+    L, dL, full_L = _gradient(L, dL, batches)
+    def update(theta):
+        # step along the derivative        
+        grad = dL(theta)
+        return -delta * grad, grad, None
+    return _first_order(L, theta_0, update, tol, maxiter, batches, eval_every, full_L)
+
+
+def momentum_descent(L, dL, theta_0, delta, alpha=0.9, tol=1e-4, maxiter=None, batches=None, eval_every=None):
+    """Gradient descent with heavy-ball momentum.
+    alpha: fraction of the velocity kept from one step to the next
+    Other arguments as gradient_descent.
+    """
+    L, dL, full_L = _gradient(L, dL, batches)
+    vel = 0
+    def update(theta):
+        nonlocal vel
+        # accumulate velocity "keep on rollin'"
+        grad = dL(theta)
+        vel = alpha * vel - delta * grad
+        return vel, grad, None
+    return _first_order(L, theta_0, update, tol, maxiter, batches, eval_every, full_L)
+
+
+def nesterov_descent(L, dL, theta_0, delta, alpha=0.9, tol=1e-4, maxiter=None, batches=None, eval_every=None):
+    """Gradient descent with Nesterov momentum: like momentum_descent, but the
+    gradient is taken where the velocity is about to carry theta.
+    Arguments as momentum_descent.
+    """
+    L, dL, full_L = _gradient(L, dL, batches)
+    vel = 0
+    def update(theta):
+        nonlocal vel
+        grad = dL(theta + alpha * vel)
+        vel = alpha * vel - delta * grad
+        return vel, grad, None
+    return _first_order(L, theta_0, update, tol, maxiter, batches, eval_every, full_L)
+
+
+def adam(L, dL, theta_0, delta=1e-3, beta_1=0.9, beta_2=0.999, eps=1e-8, tol=1e-4, maxiter=None,
+         batches=None, eval_every=None):
+    """Adam: steps scaled per parameter by running estimates of the
+    mean and variance of the gradient.
+    beta_1, beta_2: decay rates of the mean and variance estimates
+    eps: guards against division by zero
+    Other arguments as gradient_descent.
+    """
+    L, dL, full_L = _gradient(L, dL, batches)
+    m, v, t = 0, 0, 0
+    def update(theta):
+        nonlocal m, v, t
+        grad = dL(theta)
+        t += 1
+        m = beta_1 * m + (1 - beta_1) * grad
+        v = beta_2 * v + (1 - beta_2) * grad**2
+        # correct the bias from starting the estimates at zero
+        m_hat, v_hat = m / (1 - beta_1**t), v / (1 - beta_2**t)
+        return -delta * m_hat / (np.sqrt(v_hat) + eps), grad, None
+    return _first_order(L, theta_0, update, tol, maxiter, batches, eval_every, full_L)
+
+
+def line_search_descent(L, dL, theta_0, delta=1.0, shrink=0.5, c=1e-4, min_delta=1e-12, tol=1e-4, maxiter=None,
+                        batches=None, eval_every=None):
+    """Gradient descent with a backtracking (Armijo) line search: each step
+    starts at delta and shrinks until the loss decreases enough.
+    shrink: factor the step is multiplied by on each backtrack
+    c: fraction of the decrease predicted by the gradient that must be achieved
+    min_delta: smallest step tried
+    Other arguments as gradient_descent.
+    """
+    L, dL, full_L = _gradient(L, dL, batches)
+    loss = None
+    def update(theta):
+        nonlocal loss
+        # the last trial loss was on the previous batch, so only reuse it full-batch
+        if loss is None or batches is not None:
+            loss = L(theta)
+        grad = dL(theta)
+        slope = np.sum(grad**2)
+        step = delta
+        trial = L(theta - step * grad)
+        while trial > loss - c * step * slope and step > min_delta:
+            step *= shrink
+            trial = L(theta - step * grad)
+        loss = trial
+        return -step * grad, grad, trial
+    return _first_order(L, theta_0, update, tol, maxiter, batches, eval_every, full_L)
\ No newline at end of file
@@ -0,0 +1,74 @@
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, Future
+
+# number of candidates drawn and sent to the pool at a time
+BLOCK = 256
+
+
+def _seeded_call(L, theta, seed):
+    # run L with the global RNG reseeded for this candidate, so that
+    # the result doesn't depend on which worker picked it up;
+    # the caller's RNG stream is left untouched
+    if seed is None:
+        return L(theta)
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return L(theta)
+    finally:
+        np.random.set_state(state)
+
+
+def candidate_seeds(seed, start, n):
+    """Return seeds for candidates start..start+n-1, derived from one
+    base seed, or a list of None if seed is None"""
+    if seed is None:
+        return [None] * n
+    return [int(np.random.SeedSequence([seed, k]).generate_state(1)[0]) for k in range(start, start + n)]
+
+
+def evaluate(L, thetas, executor=None, seeds=None, chunksize=16):
+    """Evaluate L at each of thetas and return the losses as an array,
+    in the same order as thetas.
+    executor: a concurrent.futures executor, or None to run serially
+    seeds: optional per-candidate seeds (see candidate_seeds)
+    chunksize: number of candidates sent to a worker at once
+    """
+    thetas = list(thetas)
+    if seeds is None:
+        seeds = [None] * len(thetas)
+    if executor is None:
+        return np.array([_seeded_call(L, theta, seed) for theta, seed in zip(thetas, seeds)], dtype=float)
+    losses = executor.map(_seeded_call, [L] * len(thetas), thetas, seeds, chunksize=chunksize)
+    return np.array(list(losses), dtype=float)
+
+
+def submit(executor, fn, *args):
+    """executor.submit(fn, *args); with no executor, fn runs straight away
+    and its result comes back as an already completed future"""
+    if executor is not None:
+        return executor.submit(fn, *args)
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+@contextmanager
+def pool(executor=None, workers=None):
+    """Yield the executor to evaluate candidates with: the given executor,
+    a process pool of `workers` processes (shut down on exit),
+    or None to evaluate serially"""
+    if executor is not None or not workers:
+        yield executor
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            yield executor
+
+
+def run_seed(seed, executor=None, workers=None):
+    """Return the base seed for a run; parallel runs without an explicit
+    seed draw one from the global RNG so they stay reproducible"""
+    if seed is None and (executor is not None or workers):
+        seed = np.random.randint(0, 2**31)
+    return seed